@@ -0,0 +1,104 @@
+import itertools
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+from genanki import Deck, Note
+from genanki.apkg_col import APKG_COL
+from genanki.apkg_schema import APKG_SCHEMA
+
+
+class StreamingPackage:
+    """
+    Writes an .apkg without holding its notes in memory.
+
+    Unlike `genanki.Package`, which needs every note of every deck up front, each
+    note goes straight into the collection database as it is added (through
+    genanki's own `Note.write_to_db`), and the collection is zipped into the
+    package on `close`. Memory stays flat however many notes are written.
+    """
+
+    def __init__(self, path: str, timestamp: float = None):
+        self.path = path
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.id_gen = itertools.count(int(self.timestamp * 1000))
+        self.decks = set()
+        self.models = set()
+        # media file name in the package -> path of the file to bundle
+        self.media = {}
+        self.notes = 0
+
+        fd, self.db_path = tempfile.mkstemp(suffix='.anki2')
+        os.close(fd)
+        # packages are closed from worker threads when several are written at once
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        # a scratch file zipped once complete, durability is not needed
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.cursor = self.conn.cursor()
+        self.cursor.executescript(APKG_SCHEMA)
+        self.cursor.executescript(APKG_COL)
+
+    def add_deck(self, deck: Deck) -> None:
+        """Registers a deck, notes are added to it with `add_note` and not through `deck.notes`."""
+        if deck.deck_id in self.decks:
+            return
+        decks = json.loads(self.cursor.execute('SELECT decks FROM col').fetchone()[0])
+        decks[str(deck.deck_id)] = deck.to_json()
+        self.cursor.execute('UPDATE col SET decks = ?', (json.dumps(decks),))
+        self.decks.add(deck.deck_id)
+
+    def add_note(self, note: Note, deck: Deck) -> None:
+        self.add_deck(deck)
+        if note.model.model_id not in self.models:
+            models = json.loads(self.cursor.execute('SELECT models FROM col').fetchone()[0])
+            models[str(note.model.model_id)] = note.model.to_json(self.timestamp, deck.deck_id)
+            self.cursor.execute('UPDATE col SET models = ?', (json.dumps(models),))
+            self.models.add(note.model.model_id)
+
+        note.write_to_db(self.cursor, self.timestamp, deck.deck_id, self.id_gen)
+        self.notes += 1
+
+    def add_media(self, name: str, path: str) -> None:
+        """Bundles the file at `path` as `name`, the name the notes and templates refer to. Added once however often it is used."""
+        self.media.setdefault(name, path)
+
+    def close(self) -> None:
+        """Zips the collection into the package, next to a temporary file first so a failed export leaves no partial package."""
+        self.conn.commit()
+        self.conn.close()
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with zipfile.ZipFile(tmp_path, 'w') as outzip:
+                outzip.write(self.db_path, 'collection.anki2')
+                # as in genanki, media files are stored under their index and named in the "media" map
+                media = {}
+                for i, (name, path) in enumerate(self.media.items()):
+                    outzip.write(path, str(i))
+                    media[str(i)] = name
+                outzip.writestr('media', json.dumps(media))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        finally:
+            os.unlink(self.db_path)
+
+    def discard(self) -> None:
+        """Drops the collection of a failed export, the package itself is left as it was."""
+        self.conn.close()
+        if os.path.exists(self.db_path):
+            os.unlink(self.db_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
@@ -0,0 +1,212 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+from crawler import GRAPHQL_PATH, LeetCodeCrawler
+from job_queue import JobQueue
+from media import image_urls
+from utils import get, parser
+
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+# hop-by-hop headers of the requests session that must not be sent over HTTP/2
+SESSION_ONLY_HEADERS = {'host', 'connection'}
+
+
+class AsyncLeetCodeCrawler:
+    """
+    asyncio counterpart of `LeetCodeCrawler`, with the same fetch surface.
+
+    Requests go through one `httpx.AsyncClient` keeping a pool of up to
+    [Crawler] async_connections keep-alive connections, multiplexed over HTTP/2
+    when `h2` is installed, so hundreds of requests can be in flight without a
+    thread each. Login, cookies, the rate limiter, the response cache and every
+    database write are borrowed from the logged-in `crawler`.
+    """
+
+    def __init__(self, crawler: LeetCodeCrawler, connections: int = None):
+        self.crawler = crawler
+        self.limiter = crawler.limiter
+        self.cache = crawler.cache
+        self.media = crawler.media
+        self.connections = connections or parser.getint("Crawler", "async_connections")
+
+        headers = {
+            name: value for name, value in crawler.session.headers.items()
+            if name.lower() not in SESSION_ONLY_HEADERS
+        }
+        self.client = httpx.AsyncClient(
+            headers=headers,
+            cookies=crawler.session.cookies,
+            http2=HTTP2,
+            limits=httpx.Limits(
+                max_connections=self.connections,
+                max_keepalive_connections=self.connections,
+                keepalive_expiry=parser.getfloat("Crawler", "keepalive_seconds"),
+            ),
+            timeout=parser.getfloat("Crawler", "timeout"),
+        )
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def fetch_favourite_problems(self, contain_solution: bool):
+        await self.crawl(await asyncio.to_thread(self.crawler.plan_favourite_problems, contain_solution))
+
+    async def fetch_accepted_problems(self):
+        await self.crawl(await asyncio.to_thread(self.crawler.plan_accepted_problems))
+
+    async def crawl(self, tasks: list) -> None:
+        """
+        Drains the job queue like `LeetCodeCrawler.crawl`, with one coroutine per
+        pooled connection instead of a thread per worker.
+
+        Every database write, and the blocking catalog download, runs in a worker
+        thread (`asyncio.to_thread`) so it never stalls the requests in flight.
+        """
+        queue = await asyncio.to_thread(self.crawler.open_queue, tasks)
+        await asyncio.gather(*(self.drain(queue) for _ in range(self.connections)))
+        await asyncio.to_thread(self.crawler.close_queue, queue, tasks)
+
+    async def drain(self, queue: JobQueue) -> None:
+        batch_size = parser.getint("Crawler", "batch_size")
+        while True:
+            batch, wait = await asyncio.to_thread(queue.next_batch, batch_size)
+            if wait is None:
+                return
+            if not batch:
+                await asyncio.sleep(wait)
+                continue
+
+            for tasks in queue.attempts(batch):
+                error = None
+                try:
+                    await self.sync_batch(tasks)
+                except Exception as e:
+                    error = e
+                if await asyncio.to_thread(queue.settle, batch, tasks, error):
+                    break
+
+    async def sync_batch(self, tasks: list) -> None:
+        print(f"🤖 Fetching {len(tasks)} problems at {self.limiter.rate:.2f} req/s: {', '.join(task.slug for task in tasks)}...")
+
+        data = self.crawler.batch_data(await self.fetch(self.crawler.build_batch_query(tasks)))
+        # the submission lists and sources of the batch are fetched concurrently
+        slugs = [task.slug for task in tasks if task.contain_solution]
+        pages = [get(data, f'l{i}') for i, task in enumerate(tasks) if task.contain_solution]
+        submissions = dict(zip(slugs, await asyncio.gather(*map(self.list_new_submissions, slugs, pages))))
+
+        picked = [sub for subs in submissions.values() for sub in self.crawler.pick_submissions(subs)]
+        codes = await asyncio.gather(*(self.fetch_submission_details(sub['id']) for sub in picked))
+        await asyncio.to_thread(self.crawler.save_batch, tasks, data, submissions, {sub['id']: code for sub, code in zip(picked, codes)})
+        await self.download_media(self.crawler.batch_images(tasks, data))
+
+    async def fetch_problem(self, slug: str, accepted: bool=False) -> None:
+        print(f"🤖 Fetching problem: https://leetcode.com/problem/{slug}/...")
+
+        res = await self.fetch(self.crawler.problem_query(slug))
+        question = get(res, 'data.question')
+        content_hash = await asyncio.to_thread(self.crawler.save_problem, slug, question, accepted)
+        status = await asyncio.to_thread(self.crawler.catalog_status, slug)
+        await asyncio.to_thread(self.crawler.mark_synced, slug, status, content_hash)
+        await self.download_media(image_urls(question['content'], self.crawler.base_url))
+
+    async def fetch_solution(self, slug: str) -> None:
+        print(f"🤖 Fetching solution for problem: {slug}")
+
+        res = await self.fetch(self.crawler.note_query(slug))
+        await asyncio.to_thread(self.crawler.save_note, slug, get(res, "data.question"))
+
+    async def fetch_submission(self, slug: str) -> None:
+        print(f"🖍 Fetching submission for problem: {slug}")
+
+        submissions = await self.list_new_submissions(slug)
+        picked = self.crawler.pick_submissions(submissions)
+        codes = await asyncio.gather(*(self.fetch_submission_details(sub['id']) for sub in picked))
+
+        await asyncio.to_thread(self.crawler.store_submissions, slug, submissions, {sub['id']: code for sub, code in zip(picked, codes)})
+        await asyncio.to_thread(self.crawler.mark_submissions_listed, slug, submissions)
+
+    async def list_new_submissions(self, slug: str, page: dict = None) -> list:
+        """See `LeetCodeCrawler.list_new_submissions`."""
+        last_id = await asyncio.to_thread(self.crawler.last_listed_submission, slug)
+        submissions = []
+        query = self.crawler.next_submission_query(slug, submissions, page, last_id)
+        while query is not None:
+            page = get(await self.fetch(query), 'data.submissionList') or {}
+            query = self.crawler.next_submission_query(slug, submissions, page, last_id)
+        return submissions
+
+    async def fetch_submission_details(self, submission_id):
+        print(f"🖍 Fetching submission details code for problem: {submission_id}")
+
+        res = await self.fetch(self.crawler.submission_details_query(submission_id))
+        return get(res, "data.submissionDetails.code")
+
+    async def download_media(self, urls: list) -> int:
+        """Like `MediaStore.download`, all the images at once over the pooled connections."""
+        urls = await asyncio.to_thread(self.media.claim, urls)
+        if not urls:
+            return 0
+
+        try:
+            files = await asyncio.gather(*map(self.download_image, urls))
+            return await asyncio.to_thread(self.media.record, dict(zip(urls, files)))
+        finally:
+            self.media.release(urls)
+
+    async def download_image(self, url: str) -> str:
+        try:
+            response = await self.send('GET', url)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            print(f"❌ Failed to download image {url}, Reason: {e}")
+            return None
+        return await asyncio.to_thread(self.media.save, url, response.content, response.headers.get('Content-Type'))
+
+    async def fetch(self, query_params):
+        content = await self.request("POST", self.crawler.base_url + GRAPHQL_PATH, query_params['operationName'], query_params)
+
+        return json.loads(content)
+
+    async def request(self, method: str, url: str, operation: str, payload: dict = None) -> bytes:
+        """Same caching and revalidation as `LeetCodeCrawler.request`, on the async client."""
+        lookup = self.cache.lookup(operation, method, url, payload)
+        if lookup.is_fresh():
+            return lookup.cached.body
+
+        headers = lookup.conditional_headers()
+        data = None
+        if payload is not None:
+            headers["content-type"] = "application/json"
+            data = json.dumps(payload).encode('utf8')
+
+        response = await self.send(method, url, content=data, headers=headers)
+        return lookup.resolve(response.status_code, response.content, response.headers)
+
+    async def send(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """See `LeetCodeCrawler.send`, the wait for the rate limiter does not block the event loop."""
+        await asyncio.sleep(self.limiter.reserve())
+        started = time.monotonic()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.limiter.record(None, None)
+            raise
+
+        self.limiter.record(time.monotonic() - started, response.status_code, response.headers.get('Retry-After'))
+        if response.status_code == 429 or response.status_code >= 500:
+            response.raise_for_status()
+        return response
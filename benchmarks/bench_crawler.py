@@ -0,0 +1,141 @@
+"""
+End-to-end crawler benchmark against the local GraphQL stand-in.
+
+Every scenario crawls a favourite list and then every problem on it, with
+details, notes and submissions, into a fresh database and an empty response
+cache. It reports the requests per second the server saw, the p50/p99 HTTP
+latency measured by the client, and the time spent writing to the database.
+
+    python -m benchmarks.bench_crawler --problems 500 --latency 0.05 --workers 1 --workers 4 --batch-size 1 --batch-size 10 --use-async
+"""
+import asyncio
+import contextlib
+import io
+import itertools
+import statistics
+import tempfile
+import time
+
+import click
+
+from benchmarks.mock_server import Dataset, MockLeetCode
+from crawler import LeetCodeCrawler
+from database import create_tables, database
+from utils import parser
+
+LIST_SLUG = 'bench-list'
+
+
+class TimedCrawler(LeetCodeCrawler):
+    """Crawler recording the latency of every HTTP request and the time spent in batch writes."""
+
+    def __init__(self, workers: int = None):
+        super().__init__(workers)
+        self.latencies = []
+        self.db_time = 0.0
+        request = self.session.request
+
+        def timed_request(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return request(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - started)
+
+        self.session.request = timed_request
+
+    def save_batch(self, *args, **kwargs) -> None:
+        started = time.perf_counter()
+        try:
+            super().save_batch(*args, **kwargs)
+        finally:
+            self.db_time += time.perf_counter() - started
+
+
+async def crawl_async(crawler: TimedCrawler, connections: int) -> None:
+    from async_crawler import AsyncLeetCodeCrawler
+
+    async with AsyncLeetCodeCrawler(crawler, connections) as async_crawler:
+        request = async_crawler.client.request
+
+        async def timed_request(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await request(*args, **kwargs)
+            finally:
+                crawler.latencies.append(time.perf_counter() - started)
+
+        async_crawler.client.request = timed_request
+        await async_crawler.fetch_favourite_problems(True)
+
+
+def run_scenario(server: MockLeetCode, workers: int, batch_size: int, use_async: bool, verbose: bool) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        # a fresh database and cache per scenario, so none of them starts warm
+        database.init(f"{tmp}/LeetCode.sqlite")
+        create_tables()
+        parser.set("Cache", "path", f"{tmp}/http_cache")
+        parser.set("Media", "path", f"{tmp}/media")
+        parser.set("Crawler", "batch_size", str(batch_size))
+
+        crawler = TimedCrawler(workers)
+        before = sum(server.requests.values())
+        started = time.perf_counter()
+        with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO()):
+            crawler.fetch_favourite_questions(LIST_SLUG)
+            if use_async:
+                asyncio.run(crawl_async(crawler, workers))
+            else:
+                crawler.fetch_favourite_problems(True)
+        elapsed = time.perf_counter() - started
+        database.close()
+
+    requests = sum(server.requests.values()) - before
+    latencies = sorted(crawler.latencies)
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'scenario': f"{'async' if use_async else 'threads'} x{workers}, batch {batch_size}",
+        'requests': requests,
+        'seconds': elapsed,
+        'rps': requests / elapsed if elapsed else 0,
+        'p50': percentiles[49] if percentiles else 0,
+        'p99': percentiles[98] if percentiles else 0,
+        'db': crawler.db_time,
+    }
+
+
+@click.command()
+@click.option('--problems', type=int, default=200, help='Number of synthetic problems crawled per scenario.')
+@click.option('--submissions', type=int, default=5, help='Submissions per problem.')
+@click.option('--images', type=int, default=0, help='Distinct images embedded in the problem statements, downloaded by the crawler.')
+@click.option('--latency', type=float, default=0.02, help='Seconds the mock server adds to every response.')
+@click.option('--jitter', type=float, default=0.0, help='Up to this many random seconds added on top of the latency.')
+@click.option('--error-rate', type=float, default=0.0, help='Share of requests answered with a 500.')
+@click.option('--throttle-rate', type=float, default=0.0, help='Share of requests answered with a 429.')
+@click.option('--workers', type=int, multiple=True, default=[1, 4], help='Concurrent workers (connections with --use-async), repeatable.')
+@click.option('--batch-size', type=int, multiple=True, default=[1, 10], help='Problems per GraphQL request, repeatable.')
+@click.option('--use-async', is_flag=True, help='Also run every scenario on the asyncio crawler.')
+@click.option('--rate', type=float, default=1000, help='Starting request rate of the crawler, high enough not to throttle by default.')
+@click.option('--verbose', is_flag=True, help='Show the crawler output.')
+def main(problems, submissions, images, latency, jitter, error_rate, throttle_rate, workers, batch_size, use_async, rate, verbose):
+    server = MockLeetCode(Dataset(problems, submissions, images), 0, latency, jitter, error_rate, throttle_rate).start()
+    parser.set("Crawler", "base_url", server.url)
+    for option in ("rate", "max_rate", "burst"):
+        parser.set("Crawler", option, str(int(rate) if option == "burst" else rate))
+    # injected failures are retried right away instead of after the production backoff
+    parser.set("Crawler", "backoff_seconds", "0")
+
+    print(f"{'scenario':<24}{'requests':>10}{'seconds':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'db ms':>10}")
+    try:
+        for is_async, count, size in itertools.product([False, True] if use_async else [False], workers, batch_size):
+            result = run_scenario(server, count, size, is_async, verbose)
+            print(
+                f"{result['scenario']:<24}{result['requests']:>10}{result['seconds']:>10.2f}{result['rps']:>10.1f}"
+                f"{result['p50'] * 1000:>10.1f}{result['p99'] * 1000:>10.1f}{result['db'] * 1000:>10.1f}"
+            )
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
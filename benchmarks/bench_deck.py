@@ -0,0 +1,141 @@
+"""
+Deck generation benchmark on synthetic datasets.
+
+Fills a temporary database with `size` problems and their tags and
+submissions, then runs the steps of `render_anki` one at a time: loading the
+problems, hashing them for the export state, rendering the submissions,
+building the notes and writing them to the package. The last phase runs the
+whole streaming export again from a cold render cache. Each phase reports its time and the
+peak memory traced while it ran.
+
+    python -m benchmarks.bench_deck --size 1000 --size 5000 --size 20000
+"""
+from datetime import datetime
+import contextlib
+import io
+import random
+import tempfile
+import time
+import tracemalloc
+
+import click
+
+from apkg import StreamingPackage
+from database import BulkWriter, ProblemDetail, ProblemTag, RenderCache, Submission, Tag, create_tables, database
+from renderer import build_deck, get_anki_model, load_problems, make_note, note_checksum, render_anki, render_fields
+from utils import parser
+
+TAGS = 60
+LANGUAGES = ['python3', 'cpp', 'java']
+
+
+def populate(size: int, submissions: int, seed: int = 0) -> None:
+    """Writes `size` synthetic problems, 3 tags each and up to `submissions` submissions each."""
+    rnd = random.Random(seed)
+    with database.atomic(), BulkWriter() as writer:
+        for t in range(TAGS):
+            writer.add(Tag, name=f'Topic {t}', slug=f'topic-{t}')
+
+        for i in range(1, size + 1):
+            slug = f'problem-{i}'
+            writer.add(
+                ProblemDetail,
+                id=i,
+                display_id=i,
+                level=rnd.choice(['Easy', 'Medium', 'Hard']),
+                title=f'Problem {i}',
+                slug=slug,
+                description=f'<p>Given an array <code>nums</code> of length {i}, return the answer.</p>' * 15,
+                accepted=True,
+                clarify_questions='Clarify Questions:\n  - can the input be empty?',
+                approaches='Approaches:\nsort, then two pointers in $$O(n \\log n)$$',
+                mistakes='Mistakes:\n  - off by one',
+                edgecases='Edgecases:\n  - empty input',
+                note='Note:\nNone',
+            )
+            for t in rnd.sample(range(TAGS), 3):
+                writer.add(ProblemTag, problem=i, tag=f'topic-{t}')
+            for n in range(rnd.randint(1, submissions)):
+                writer.add(
+                    Submission,
+                    id=i * 10 + n,
+                    slug=slug,
+                    language=LANGUAGES[n % len(LANGUAGES)],
+                    source='\n'.join(f'    x{k} = nums[{k}] * {i} + {n}  # step {k}' for k in range(40)),
+                    submitted_date=datetime(2024, 1, 1),
+                )
+
+
+@contextlib.contextmanager
+def phase(results: list, name: str, memory: bool):
+    if memory:
+        tracemalloc.reset_peak()
+    started = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] if memory else 0
+    results.append((name, elapsed, peak))
+
+
+def run(size: int, submissions: int, workers: int, memory: bool) -> list:
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        database.init(f"{tmp}/LeetCode.sqlite")
+        parser.set("Media", "path", f"{tmp}/media")
+        create_tables()
+        populate(size, submissions)
+
+        if memory:
+            tracemalloc.start()
+        # make_note and the renderer report every note, keep them out of the measurement
+        with contextlib.redirect_stdout(io.StringIO()):
+            with phase(results, 'query', memory):
+                problems = load_problems()
+
+            with phase(results, 'checksum', memory):
+                checksums = [note_checksum(*item) for item in problems]
+
+            with phase(results, 'render', memory):
+                submission_html = render_fields(problems, workers)
+
+            with phase(results, 'notes', memory):
+                model = get_anki_model()
+                deck = build_deck("LeetCode")
+                notes = [make_note(problem, tags, html, model) for (problem, tags, _), html in zip(problems, submission_html)]
+
+            with phase(results, 'write', memory):
+                with StreamingPackage(f"{tmp}/LeetCode.apkg") as package:
+                    for note in notes:
+                        package.add_note(note, deck)
+
+            del problems, checksums, submission_html, notes
+            RenderCache.delete().execute()
+            with phase(results, 'export', memory):
+                render_anki(workers, output=f"{tmp}/LeetCode.apkg")
+        if memory:
+            tracemalloc.stop()
+
+        database.close()
+    return results
+
+
+@click.command()
+@click.option('--size', type=int, multiple=True, default=[1000, 5000, 20000], help='Number of synthetic problems, repeatable.')
+@click.option('--submissions', type=int, default=2, help='Most submissions per problem.')
+@click.option('--workers', type=int, default=1, help='Render processes, 0 uses every CPU core. Memory is only traced in this process.')
+@click.option('--memory/--no-memory', default=True, help='Trace peak memory per phase, which slows every phase down.')
+def main(size, submissions, workers, memory):
+    print(f"{'problems':>10}  {'phase':<10}{'seconds':>10}{'peak MB':>10}")
+    for count in size:
+        results = run(count, submissions, workers, memory)
+        # the export phase repeats the steps end to end, it is not part of their total
+        steps = [item for item in results if item[0] != 'export']
+        for name, elapsed, peak in steps:
+            print(f"{count:>10}  {name:<10}{elapsed:>10.2f}{peak / 2 ** 20:>10.1f}")
+        print(f"{count:>10}  {'total':<10}{sum(item[1] for item in steps):>10.2f}{max(item[2] for item in steps) / 2 ** 20:>10.1f}")
+        for name, elapsed, peak in results[len(steps):]:
+            print(f"{count:>10}  {name:<10}{elapsed:>10.2f}{peak / 2 ** 20:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""
+Local stand-in for the parts of leetcode.com the crawler talks to.
+
+Serves the all-problems payload and the `favoriteQuestionList`,
+`getQuestionDetail`, `QuestionNote`, `Submissions`, `submissionDetails`,
+`recentAcSubmissions` and aliased `batchProblems` GraphQL operations from a
+deterministic synthetic dataset. A recorded response saved as `<operationName>.json` in the fixtures
+directory is replayed verbatim instead. Problem statements can embed images
+served under `/uploads/`, shared between problems. Every response can be
+delayed, and turned into a 500 or a 429 at a configurable rate.
+
+    python -m benchmarks.mock_server --problems 500 --latency 0.05 --error-rate 0.01
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import pathlib
+import random
+import re
+from threading import Lock, Thread
+import time
+
+import click
+
+LANGUAGES = ['python3', 'cpp', 'java']
+
+
+class Dataset:
+    """
+    Synthetic problems, each with `submissions` submissions of which every third
+    is accepted, and one of `images` distinct images in its statement.
+    """
+
+    def __init__(self, problems: int, submissions: int = 5, images: int = 0):
+        self.problems = problems
+        self.submissions = submissions
+        self.images = images
+
+    def slug(self, i: int) -> str:
+        return f'problem-{i}'
+
+    def index(self, slug: str) -> int:
+        return int(slug.rsplit('-', 1)[1])
+
+    def all_problems(self) -> dict:
+        return {
+            'stat_status_pairs': [
+                {
+                    'stat': {
+                        'question_id': i,
+                        'frontend_question_id': i,
+                        'question__title': f'Problem {i}',
+                        'question__title_slug': self.slug(i),
+                    },
+                    'difficulty': {'level': i % 3 + 1},
+                    'status': 'ac',
+                    'paid_only': False,
+                    'is_favor': True,
+                }
+                for i in range(1, self.problems + 1)
+            ]
+        }
+
+    def list_item(self, i: int) -> dict:
+        return {
+            'id': i,
+            'questionFrontendId': str(i),
+            'title': f'Problem {i}',
+            'titleSlug': self.slug(i),
+            'difficulty': ['EASY', 'MEDIUM', 'HARD'][i % 3],
+            'status': 'SOLVED',
+            'acRate': 50.0,
+            'frequency': 1.0 / i,
+            'topicTags': [{'name': 'Array', 'slug': 'array'}],
+        }
+
+    def question(self, slug: str) -> dict:
+        i = self.index(slug)
+        return {
+            'questionId': str(i),
+            'questionFrontendId': str(i),
+            'questionTitle': f'Problem {i}',
+            'questionTitleSlug': slug,
+            'content': f'<p>Statement of problem {i}.</p>' * 20 + (f'<img src="/uploads/figure-{i % self.images}.png" />' if self.images else ''),
+            'difficulty': ['Easy', 'Medium', 'Hard'][i % 3],
+            'stats': '{}',
+            'similarQuestions': '[]',
+            'categoryTitle': 'Algorithms',
+            'topicTags': [{'name': 'Array', 'slug': 'array'}, {'name': f'Topic {i % 10}', 'slug': f'topic-{i % 10}'}],
+            'article': None,
+            'note': 'clarify questions:\n- none\nedgecases:\n- empty input\napproaches:\n- brute force\nmistakes:\n- none\nnote: ok',
+            'solution': {'id': str(i), 'content': '', 'contentTypeId': '1', 'canSeeDetail': True, 'paidOnly': False, 'rating': None},
+        }
+
+    def submission_list(self, slug: str, offset: int, limit: int) -> dict:
+        i = self.index(slug)
+        submissions = [
+            {
+                'id': str(i * 1000 + n),
+                'statusDisplay': 'Accepted' if n % 3 == 0 else 'Wrong Answer',
+                'lang': LANGUAGES[n % len(LANGUAGES)],
+                'runtime': '10 ms',
+                'timestamp': str(1700000000 + n),
+                'url': f'/submissions/detail/{i * 1000 + n}/',
+                'isPending': 'Not Pending',
+            }
+            for n in range(self.submissions, 0, -1)
+        ]
+        page = submissions[offset:offset + limit]
+        return {
+            'lastKey': page[-1]['id'] if page else None,
+            'hasNext': offset + limit < len(submissions),
+            'submissions': page,
+        }
+
+    def recent_accepted(self, limit: int) -> list:
+        """Newest accepted submission of the first `limit` problems."""
+        newest = self.submissions - self.submissions % 3
+        if not newest:
+            return []
+        return [
+            {'id': str(i * 1000 + newest), 'titleSlug': self.slug(i), 'timestamp': str(1700000000 + newest)}
+            for i in range(1, min(limit, self.problems) + 1)
+        ]
+
+    def submission_code(self, submission_id) -> dict:
+        return {'code': f'class Solution:\n    def solve(self):\n        return {submission_id}\n' * 5, 'timestamp': 1700000000}
+
+    def image(self, name: str) -> bytes:
+        """Bytes standing in for an uploaded image, distinct per name."""
+        return b'\x89PNG\r\n\x1a\n' + name.encode('utf-8') * 64
+
+    def graphql(self, payload: dict) -> dict:
+        operation, variables = payload.get('operationName'), payload.get('variables') or {}
+        if operation == 'favoriteQuestionList':
+            skip, limit = variables.get('skip') or 0, variables.get('limit') or self.problems
+            ids = range(skip + 1, min(skip + limit, self.problems) + 1)
+            return {'favoriteQuestionList': {
+                'questions': [self.list_item(i) for i in ids],
+                'totalLength': self.problems,
+                'hasMore': skip + limit < self.problems,
+            }}
+        if operation in ('getQuestionDetail', 'QuestionNote'):
+            return {'question': self.question(variables['titleSlug'])}
+        if operation == 'Submissions':
+            return {'submissionList': self.submission_list(variables['questionSlug'], variables['offset'], variables['limit'])}
+        if operation == 'submissionDetails':
+            return {'submissionDetails': self.submission_code(variables['submissionId'])}
+        if operation == 'batchProblems':
+            data = {}
+            for alias, i in re.findall(r'\b([ql])(\d+):', payload['query']):
+                slug = variables[f's{i}']
+                if alias == 'q':
+                    data[f'q{i}'] = self.question(slug)
+                else:
+                    limit = int(re.search(rf'\bl{i}: submissionList\(offset: 0, limit: (\d+)', payload['query']).group(1))
+                    data[f'l{i}'] = self.submission_list(slug, 0, limit)
+            return data
+        if operation == 'recentAcSubmissions':
+            return {'recentAcSubmissionList': self.recent_accepted(variables['limit'])}
+        if operation == 'globalData':
+            return {'userStatus': {'isSignedIn': True, 'username': 'bench'}}
+        return None
+
+
+class MockLeetCode(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, dataset: Dataset, port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, fixtures: str = None, seed: int = 0):
+        super().__init__(('127.0.0.1', port), Handler)
+        self.dataset = dataset
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.fixtures = pathlib.Path(fixtures) if fixtures else None
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.requests = {}
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self) -> 'MockLeetCode':
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def count(self, operation: str) -> None:
+        with self.lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+
+    def fault(self) -> int:
+        """Status code of an injected failure, None when the request goes through."""
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    def delay(self) -> None:
+        with self.lock:
+            extra = self.random.uniform(0, self.jitter) if self.jitter else 0
+        if self.latency or extra:
+            time.sleep(self.latency + extra)
+
+    def fixture(self, operation: str) -> bytes:
+        if self.fixtures is None:
+            return None
+        path = self.fixtures / f'{operation}.json'
+        return path.read_bytes() if path.is_file() else None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in separate writes, Nagle would hold the body back for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.path.startswith('/uploads/'):
+            return self.serve('image', lambda: self.server.dataset.image(self.path.rsplit('/', 1)[1]), 'image/png')
+        if not self.path.startswith('/api/problems/all'):
+            return self.reply(404, b'{}')
+        self.serve('catalog', lambda: self.server.dataset.all_problems())
+
+    def do_POST(self):
+        if not self.path.startswith('/graphql'):
+            return self.reply(404, b'{}')
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+
+        def respond():
+            data = self.server.dataset.graphql(payload)
+            return {'data': data} if data is not None else {'errors': [{'message': 'unknown operation'}]}
+
+        self.serve(payload.get('operationName') or 'unknown', respond)
+
+    def serve(self, operation: str, respond, content_type: str = 'application/json') -> None:
+        server = self.server
+        server.count(operation)
+        server.delay()
+
+        status = server.fault()
+        if status == 429:
+            return self.reply(429, b'{}', {'Retry-After': '1'})
+        if status:
+            return self.reply(status, b'{}')
+
+        if content_type != 'application/json':
+            return self.reply(200, respond(), content_type=content_type)
+        body = server.fixture(operation) or json.dumps(respond()).encode('utf-8')
+        self.reply(200, body)
+
+    def reply(self, status: int, body: bytes, headers: dict = None, content_type: str = 'application/json') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@click.command()
+@click.option('--port', type=int, default=8765, help='Port to listen on.')
+@click.option('--problems', type=int, default=500, help='Number of synthetic problems.')
+@click.option('--submissions', type=int, default=5, help='Submissions per problem.')
+@click.option('--images', type=int, default=0, help='Distinct images embedded in the problem statements, 0 for none.')
+@click.option('--latency', type=float, default=0.0, help='Seconds added to every response.')
+@click.option('--jitter', type=float, default=0.0, help='Up to this many random seconds added on top of the latency.')
+@click.option('--error-rate', type=float, default=0.0, help='Share of requests answered with a 500.')
+@click.option('--throttle-rate', type=float, default=0.0, help='Share of requests answered with a 429.')
+@click.option('--fixtures', type=click.Path(exists=True, file_okay=False), default=None, help='Directory of recorded <operationName>.json responses to replay.')
+def main(port, problems, submissions, images, latency, jitter, error_rate, throttle_rate, fixtures):
+    server = MockLeetCode(Dataset(problems, submissions, images), port, latency, jitter, error_rate, throttle_rate, fixtures)
+    print(f"🤖 Serving {problems} problems on {server.url}, set [Crawler] base_url to it")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,12 @@
+import asyncio
+
 from csv_processor import CSVProcessor
 from database import create_tables
-from crawler import LeetCodeCrawler
-from renderer import render_anki
+from crawler import COMPANY_LISTS, LeetCodeCrawler
+from renderer import problem_selection, render_anki
+from search import PROBLEM_WEIGHTS, fts_query, plain_snippet, search_problems, search_submissions
 import click
+from peewee import OperationalError
 
 create_tables()
 
@@ -15,33 +19,62 @@ def cli():
 
 @cli.command()
 @click.option('--contain_solution', is_flag=False, help='Does you need to fecth solution or submission.')
-def fetch_question_detail(contain_solution: bool):
-    worker = LeetCodeCrawler()
-    worker.login()
-    worker.fetch_favourite_problems(contain_solution)    
+@click.option('--workers', type=int, default=None, help='Number of problems fetched concurrently, defaults to [Crawler] workers.')
+@click.option('--use-async', is_flag=True, help='Crawl on asyncio over a pooled HTTP/2 client instead of threads.')
+@click.option('--all-languages', is_flag=True, help='Download the newest accepted submission of every language, defaults to [Sync] all_languages.')
+def fetch_question_detail(contain_solution: bool, workers: int, use_async: bool, all_languages: bool):
+    with LeetCodeCrawler(workers) as worker:
+        worker.all_languages = worker.all_languages or all_languages
+        worker.login()
+        if use_async:
+            asyncio.run(fetch_favourite_problems_async(worker, contain_solution))
+        else:
+            worker.fetch_favourite_problems(contain_solution)
     
     render_anki()
 
 
+async def fetch_favourite_problems_async(worker: LeetCodeCrawler, contain_solution: bool):
+    from async_crawler import AsyncLeetCodeCrawler
+
+    async with AsyncLeetCodeCrawler(worker) as async_worker:
+        await async_worker.fetch_favourite_problems(contain_solution)
+
+
 @cli.command()
 @click.option('--slug', type=str, prompt='The slug of problem list.')
-@click.option('--size', type=int, prompt='Number of item want to fetch.')
+@click.option('--size', type=int, default=None, help='Number of item want to fetch, defaults to the whole list.')
 def fetch_favourite_questions(slug: str, size: int):
-    worker = LeetCodeCrawler()
-    worker.login()
-    
-    worker.fetch_favourite_questions(slug, 0, size)
+    with LeetCodeCrawler() as worker:
+        worker.login()
+        worker.fetch_favourite_questions(slug, 0, size)
     
 
 @cli.command()
-@click.option('--slug', type=click.Choice(['amazon-all', 'google-all', 'facebook-all', 'microsoft-all', 'amazon-three-months','google-three-months', 'facebook-three-months', 'microsoft-three-months', 'tiktok-six-months']), prompt='The company slug')
-@click.option('--size', type=int, prompt='Number of item want to fetch.')
+@click.option('--slug', type=click.Choice(COMPANY_LISTS), prompt='The company slug')
+@click.option('--size', type=int, default=None, help='Number of item want to fetch, defaults to the whole list.')
 def fetch_top_questions(slug: str, size: int):
-    worker = LeetCodeCrawler()
-    worker.login()
-    
-    worker.fetch_top_questions_by_company(slug, 0, size)
-    
+    with LeetCodeCrawler() as worker:
+        worker.login()
+        worker.fetch_top_questions_by_company(slug, 0, size)
+
+
+@cli.command()
+@click.option('--slug', type=click.Choice(COMPANY_LISTS), multiple=True, help='Company slugs to sync, defaults to every company list.')
+@click.option('--size', type=int, default=None, help='Number of item want to fetch per list, defaults to the whole list.')
+@click.option('--workers', type=int, default=None, help='Number of lists fetched concurrently, defaults to [Crawler] workers.')
+def sync_top_questions(slug: tuple, size: int, workers: int):
+    with LeetCodeCrawler(workers) as worker:
+        worker.login()
+        worker.fetch_top_questions(list(slug), size)
+
+
+@cli.command()
+def fetch_media():
+    """Downloads the images of the stored problems missing from the media store, under the crawl rate limit."""
+    with LeetCodeCrawler() as worker:
+        print(f"🤖 Downloaded {worker.media.backfill()} images to {worker.media.path}")
+
 
 @cli.command()
 def sync_leetcode_track():
@@ -50,8 +83,43 @@ def sync_leetcode_track():
 
 
 @cli.command()
-def generate_deck():
-    render_anki()
+@click.option('--workers', type=int, default=None, help='Processes rendering notes and writing packages, defaults to [Anki] workers (0 uses every CPU core).')
+@click.option('--delta', is_flag=True, help='Only export the notes changed since the last export.')
+@click.option('--tag', type=str, multiple=True, help='Only problems with one of these tag slugs.')
+@click.option('--difficulty', type=click.Choice(['Easy', 'Medium', 'Hard'], case_sensitive=False), multiple=True, help='Only problems of these difficulties.')
+@click.option('--company', type=str, default=None, help='Only top questions of this company, e.g. amazon, in any of its lists.')
+@click.option('--min-frequency', type=float, default=0.0, help='Lowest frequency in one of the company lists selected with --company.')
+@click.option('--favourite', is_flag=True, help='Only problems on the favourite list.')
+@click.option('--track-status', type=click.Choice(['TO_DO', 'REVISIT']), multiple=True, help='Only problems tracked with these statuses.')
+@click.option('--shard-by', type=click.Choice(['level', 'tag']), default=None, help='Split the notes into LeetCode::<shard> subdecks.')
+@click.option('--packages', is_flag=True, help='With --shard-by, write one package per shard instead of subdecks.')
+@click.option('--output', type=click.Path(dir_okay=False), default=None, help='Package path, defaults to [Anki] output.')
+def generate_deck(workers: int, delta: bool, tag: tuple, difficulty: tuple, company: str, min_frequency: float,
+                  favourite: bool, track_status: tuple, shard_by: str, packages: bool, output: str):
+    if packages and not shard_by:
+        raise click.UsageError("--packages needs --shard-by to split the notes into packages.")
+    selection = problem_selection(tag, difficulty, company, min_frequency, favourite, track_status)
+    render_anki(workers, delta, selection, shard_by, packages, output)
+
+
+@cli.command()
+@click.argument('text')
+@click.option('--scope', type=click.Choice(['problems', 'submissions', 'all']), default='all', help='What to search.')
+@click.option('--field', type=click.Choice([*PROBLEM_WEIGHTS, 'notes']), multiple=True, help='Only match these problem fields, "notes" for every personal note field.')
+@click.option('--limit', type=int, default=20, help='Results per scope.')
+@click.option('--raw', is_flag=True, help='TEXT is an FTS5 query (OR, NEAR, prefix*, column filters).')
+def search(text: str, scope: str, field: tuple, limit: int, raw: bool):
+    try:
+        if scope in ('problems', 'all'):
+            for row in search_problems(fts_query(text, field, raw), limit):
+                click.echo(f"🔎 {row['display_id']}. {row['title']} (https://leetcode.com/problems/{row['slug']}/)")
+                click.echo(f"   {plain_snippet(row['snippet'])}")
+        if scope in ('submissions', 'all') and not field:
+            for row in search_submissions(fts_query(text, raw=raw), limit):
+                click.echo(f"🖍 {row['slug']} [{row['language']}] #{row['id']}")
+                click.echo(f"   {plain_snippet(row['snippet'])}")
+    except OperationalError as e:
+        raise click.BadParameter(f"Invalid search query: {e}", param_hint='TEXT')
 
 
 if __name__ == '__main__':
@@ -1,69 +1,278 @@
-from datetime import datetime
+import codecs
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 import json
 import os.path
 import pickle
 import re
 from sys import exit
+from threading import Event
 import time
+from urllib.parse import urlparse
 
 import requests
 from requests.cookies import RequestsCookieJar
-from selenium import webdriver
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
 
-from database import ProblemDetail, ProblemTag, Tag, Submission, create_tables, Solution, FavouriteQuestion, TopQuestion
-from utils import destructure, random_wait, do, get
+from http_cache import ResponseCache
+from job_queue import CrawlTask, JobQueue
+from media import MediaStore, image_urls
+from peewee import JOIN, fn
+
+from database import BulkWriter, database, Catalog, ProblemDetail, ProblemTag, Tag, Submission, create_tables, Solution, FavouriteQuestion, TopQuestion, SyncState, SubmissionIndex
+from utils import AdaptiveRateLimiter, content_hash, destructure, get, iter_json_array, parser
 
 COOKIE_PATH = "./cookies.dat"
-GRAPHQL_URL = "https://leetcode.com/graphql"
+# endpoints, relative to [Crawler] base_url
+GRAPHQL_PATH = "/graphql"
+ALL_PROBLEMS_PATH = "/api/problems/all/"
+
+# company lists of top questions, by favourite slug
+COMPANY_LISTS = [
+    'amazon-all', 'google-all', 'facebook-all', 'microsoft-all',
+    'amazon-three-months', 'google-three-months', 'facebook-three-months', 'microsoft-three-months',
+    'tiktok-six-months',
+]
+
+# field selections shared by the single-problem queries and the batched, aliased one
+QUESTION_DETAIL_FIELDS = '''
+    questionId
+    questionFrontendId
+    questionTitle
+    questionTitleSlug
+    content
+    difficulty
+    stats
+    similarQuestions
+    categoryTitle
+    topicTags {
+        name
+        slug
+    }
+'''
+
+QUESTION_NOTE_FIELDS = '''
+    questionId
+    article
+    note
+    solution {
+      id
+      content
+      contentTypeId
+      canSeeDetail
+      paidOnly
+      rating {
+        id
+        count
+        average
+        userRating {
+          score
+          __typename
+        }
+        __typename
+      }
+      __typename
+    }
+    __typename
+'''
+
+FAVORITE_QUESTION_LIST_QUERY = '''
+query favoriteQuestionList(
+    $favoriteSlug: String!, 
+    $filter: FavoriteQuestionFilterInput, 
+    $filtersV2: QuestionFilterInput, 
+    $searchKeyword: String, 
+    $sortBy: QuestionSortByInput, 
+    $limit: Int, 
+    $skip: Int, 
+    $version: String = "v2"
+) {
+    favoriteQuestionList(
+        favoriteSlug: $favoriteSlug
+        filter: $filter
+        filtersV2: $filtersV2
+        searchKeyword: $searchKeyword
+        sortBy: $sortBy
+        limit: $limit
+        skip: $skip
+        version: $version
+    ) {
+        questions {
+            id
+            questionFrontendId
+            title
+            titleSlug
+            difficulty
+            status
+            acRate
+            frequency
+            topicTags {
+                name
+                slug
+            }
+        }
+        totalLength
+        hasMore
+    }
+}
+'''
+
+SUBMISSION_LIST_FIELDS = '''
+    lastKey
+    hasNext
+    submissions {
+        id
+        statusDisplay
+        lang
+        runtime
+        timestamp
+        url
+        isPending
+        __typename
+    }
+    __typename
+'''
+
+RECENT_AC_SUBMISSIONS_QUERY = '''
+query recentAcSubmissions($username: String!, $limit: Int!) {
+    recentAcSubmissionList(username: $username, limit: $limit) {
+        id
+        titleSlug
+        timestamp
+    }
+}
+'''
 
 class LeetCodeCrawler:
-    def __init__(self):
+    def __init__(self, workers: int = None):
         # create an http session
         self.session = requests.Session()
-        self.browser = webdriver.Chrome(service=webdriver.ChromeService(executable_path="./driver/chromedriver"))
+        # leetcode.com, or a local stand-in such as the benchmark's mock server
+        self.base_url = parser.get("Crawler", "base_url").rstrip('/')
+        # one rate budget shared by every worker thread, adapting to how the server responds
+        self.limiter = AdaptiveRateLimiter(
+            parser.getfloat("Crawler", "rate"),
+            parser.getint("Crawler", "burst"),
+            min_rate=parser.getfloat("Crawler", "min_rate"),
+            max_rate=parser.getfloat("Crawler", "max_rate"),
+            increase=parser.getfloat("Crawler", "rate_increase"),
+            target_latency=parser.getfloat("Crawler", "target_latency"),
+        )
+        self.workers = workers or parser.getint("Crawler", "workers")
+        # download the newest accepted submission of every language, not just the newest one
+        self.all_languages = parser.getboolean("Sync", "all_languages")
+        self.cache = ResponseCache()
+        # the browser is only needed for interactive login, see `browser`
+        self._browser = None
+        # name of the signed in user, read with the session status on first use
+        self._username = None
         self.session.headers.update(
             {
-                'Host': 'leetcode.com',
+                'Host': urlparse(self.base_url).netloc,
                 'Cache-Control': 'max-age=0',
                 'Upgrade-Insecure-Requests': '1',
-                'Referer': 'https://leetcode.com/accounts/login/',
+                'Referer': f'{self.base_url}/accounts/login/',
                 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/54.0.2840.98 Safari/537.36',
                 'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
                 'Accept-Language': 'zh-CN,zh;q=0.8,en;q=0.6',
                 'Connection': 'keep-alive'
             }
         )
+        # images of the problem statements, downloaded once into a local store for offline cards,
+        # under the same rate budget as the crawl
+        self.media = MediaStore(headers={'User-Agent': self.session.headers['User-Agent']}, limiter=self.limiter)
+
+    @property
+    def browser(self):
+        if self._browser is None:
+            # selenium is imported on first use too, cookie-authenticated runs never pay for it
+            from selenium import webdriver
+            self._browser = webdriver.Chrome(service=webdriver.ChromeService(executable_path="./driver/chromedriver"))
+        return self._browser
+
+    def quit_browser(self):
+        if self._browser is not None:
+            self._browser.quit()
+            self._browser = None
+
+    def close(self):
+        self.media.close()
+        self.quit_browser()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def login(self):
-        browser_cookies = {}
-        if os.path.isfile(COOKIE_PATH):
-            with open(COOKIE_PATH, 'rb') as f:
-                browser_cookies = pickle.load(f)
-        else:
-            print("😎 Starting browser login..., please fill the login form")
-            try:
-                # browser login
-                login_url = "https://leetcode.com/accounts/login"
-                self.browser.get(login_url)
+        browser_cookies = self.load_cookies()
+        if browser_cookies is None:
+            browser_cookies = self.browser_login()
+        self.use_cookies(browser_cookies)
 
-                WebDriverWait(self.browser, 24 * 60 * 3600).until(
-                    lambda driver: driver.current_url.find("login") < 0
-                )
+        if not self.is_signed_in():
+            print("🤔 Saved session is no longer valid")
+            self.use_cookies(self.browser_login())
+
+    def load_cookies(self) -> list:
+        """Returns the saved browser cookies, or None when there are none or the session cookie has expired."""
+        if not os.path.isfile(COOKIE_PATH):
+            return None
+
+        with open(COOKIE_PATH, 'rb') as f:
+            browser_cookies = pickle.load(f)
+
+        for item in browser_cookies:
+            if item['name'] == 'LEETCODE_SESSION' and item.get('expiry') and item['expiry'] < time.time():
+                return None
+        return browser_cookies
+
+    def is_signed_in(self) -> bool:
+        query_params = {
+            'operationName': "globalData",
+            'variables': {},
+            'query': 'query globalData { userStatus { isSignedIn username } }',
+        }
+        res = self.fetch(query_params)
+        self._username = get(res, 'data.userStatus.username') or ''
+        return bool(get(res, 'data.userStatus.isSignedIn'))
+
+    @property
+    def username(self) -> str:
+        if self._username is None:
+            self.is_signed_in()
+        return self._username
+
+    def browser_login(self) -> list:
+        from selenium.webdriver.support.ui import WebDriverWait
+
+        print("😎 Starting browser login..., please fill the login form")
+        try:
+            # browser login
+            login_url = f"{self.base_url}/accounts/login"
+            self.browser.get(login_url)
+
+            WebDriverWait(self.browser, 24 * 60 * 3600).until(
+                lambda driver: driver.current_url.find("login") < 0
+            )
+
+            # Wait for user to complete 2FA manually
+            time.sleep(10)
 
-                # Wait for user to complete 2FA manually
-                time.sleep(10)
+            browser_cookies = self.browser.get_cookies()
+            with open(COOKIE_PATH, 'wb') as f:
+                pickle.dump(browser_cookies, f)
+            print("🎉 Login successfully")
 
-                browser_cookies = self.browser.get_cookies()
-                with open(COOKIE_PATH, 'wb') as f:
-                    pickle.dump(browser_cookies, f)
-                print("🎉 Login successfully")
+        except Exception as e:
+            print(f"🤔 Login Failed: {e}, please try again")
+            exit()
+        finally:
+            self.quit_browser()
 
-            except Exception as e:
-                print(f"🤔 Login Failed: {e}, please try again")
-                exit()
+        return browser_cookies
 
+    def use_cookies(self, browser_cookies: list) -> None:
         cookies = RequestsCookieJar()
         for item in browser_cookies:
             cookies.set(item['name'], item['value'])
@@ -75,48 +284,80 @@ class LeetCodeCrawler:
 
         self.session.cookies.update(cookies)
 
-    def fetch_favourite_questions(self, slug, skip = 0, limit = 200):
+    def fetch_favourite_questions(self, slug, skip = 0, limit = None):
         print(f"🤖 Fetching problems from Favourite List: https://leetcode.com/problem/{slug}/...")
-        
-        query = '''
-        query favoriteQuestionList(
-            $favoriteSlug: String!, 
-            $filter: FavoriteQuestionFilterInput, 
-            $filtersV2: QuestionFilterInput, 
-            $searchKeyword: String, 
-            $sortBy: QuestionSortByInput, 
-            $limit: Int, 
-            $skip: Int, 
-            $version: String = "v2"
-        ) {
-            favoriteQuestionList(
-                favoriteSlug: $favoriteSlug
-                filter: $filter
-                filtersV2: $filtersV2
-                searchKeyword: $searchKeyword
-                sortBy: $sortBy
-                limit: $limit
-                skip: $skip
-                version: $version
-            ) {
-                questions {
-                    id
-                    title
-                    titleSlug
-                    difficulty
-                    status
-                    acRate
-                    topicTags {
-                        name
-                        slug
-                    }
-                }
-                totalLength
-                hasMore
-            }
-        }
-        '''
 
+        sort_by = {"sortField": "CUSTOM", "sortOrder": "ASCENDING"}
+        return self.sync_question_list(slug, 'favourite', sort_by, self.save_favourite_questions, skip, limit)
+
+    def fetch_top_questions_by_company(self, company_slug: str, skip = 0, limit = None):
+        print(f"🤖 Fetching problems from Company List: https://leetcode.com/problem/{company_slug}/...")
+
+        sort_by = {"sortField": "FREQUENCY", "sortOrder": "DESCENDING"}
+        save = lambda questions: self.save_top_questions(company_slug, questions)
+        return self.sync_question_list(company_slug, 'company', sort_by, save, skip, limit)
+
+    def fetch_top_questions(self, company_slugs: list = None, limit: int = None) -> int:
+        """
+        Syncs several company lists in one run, fetched concurrently under the
+        shared rate limit with the already authenticated session.
+
+        :return: Number of questions synced across all lists.
+        """
+        company_slugs = company_slugs or COMPANY_LISTS
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.fetch_top_questions_by_company, slug, 0, limit) for slug in company_slugs]
+            total = sum(future.result() for future in futures)
+
+        print(f"🤖 Synced {total} problems from {len(company_slugs)} company lists")
+        return total
+
+    def sync_question_list(self, slug: str, kind: str, sort_by: dict, save, skip: int = 0, limit: int = None) -> int:
+        """
+        Walks every page of a favourite or company list and hands each page to
+        `save` as soon as it arrives, so memory stays flat however long the list is.
+
+        :return: Number of questions synced.
+        """
+        count = 0
+        for questions in self.iter_question_list_pages(slug, sort_by, skip, limit):
+            save(questions)
+            count += len(questions)
+
+        print(f"🤖 Number of {kind.title()} {count} problems")
+        return count
+
+    def iter_question_list_pages(self, slug: str, sort_by: dict, skip: int = 0, limit: int = None, prefetch: bool = True):
+        """
+        Yields the questions of `favoriteQuestionList` page by page, following
+        `hasMore` until the list (or `limit` questions) is exhausted. With
+        `prefetch`, the next page is requested while the caller stores the current one.
+        """
+        page_size = parser.getint("Crawler", "page_size")
+        end = skip + limit if limit is not None else None
+
+        def fetch_page(offset):
+            size = page_size if end is None else min(page_size, end - offset)
+            return self.fetch_question_list_page(slug, sort_by, offset, size)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(fetch_page, skip)
+            while next_page is not None:
+                page = next_page.result() or {}
+                questions = page.get('questions') or []
+                skip += len(questions)
+
+                has_more = page.get('hasMore') and questions and (end is None or skip < end)
+                next_page = None
+                if has_more and prefetch:
+                    next_page = executor.submit(fetch_page, skip)
+
+                yield questions
+
+                if has_more and not prefetch:
+                    next_page = executor.submit(fetch_page, skip)
+
+    def fetch_question_list_page(self, slug: str, sort_by: dict, skip: int, limit: int) -> dict:
         variables = {
             "favoriteSlug": slug,
             "limit": limit,
@@ -127,193 +368,373 @@ class LeetCodeCrawler:
                 "difficultyFilter": {"difficulties": [], "operator": "IS"},
                 "topicFilter": {"topicSlugs": [], "operator": "IS"}
             },
-            "sortBy": {"sortField": "CUSTOM", "sortOrder": "ASCENDING"},
+            "sortBy": sort_by,
             "searchKeyword": ""
         }
 
         query_params = {
             "operationName": "favoriteQuestionList",
             "variables": variables, 
-            "query": query, 
+            "query": FAVORITE_QUESTION_LIST_QUERY, 
         }
-        
+
         res = self.fetch(query_params)
-        
-        # parse data
-        questions = get(res, 'data.favoriteQuestionList.questions')
-        for question in questions:
-            FavouriteQuestion.replace(
-                slug=question['titleSlug'],
-                status=question['status'],
-                title=f'{question['questionFrontendId']}. {question['title']}',
-            ).execute()
-        
-        print(f"🤖 Number of Favourite {len(questions)} problems")
-        return questions    
-        
-    def fetch_top_questions_by_company(self, company_slug: str, skip = 0, limit = 200):
-        print(f"🤖 Fetching problems from Company List: https://leetcode.com/problem/{company_slug}/...")
-        
-        query = '''
-        query favoriteQuestionList(
-            $favoriteSlug: String!, 
-            $filter: FavoriteQuestionFilterInput, 
-            $filtersV2: QuestionFilterInput, 
-            $searchKeyword: String, 
-            $sortBy: QuestionSortByInput, 
-            $limit: Int, 
-            $skip: Int, 
-            $version: String = "v2"
-        ) {
-            favoriteQuestionList(
-                favoriteSlug: $favoriteSlug
-                filter: $filter
-                filtersV2: $filtersV2
-                searchKeyword: $searchKeyword
-                sortBy: $sortBy
-                limit: $limit
-                skip: $skip
-                version: $version
-            ) {
-                questions {
-                    id
-                    title
-                    titleSlug
-                    difficulty
-                    status
-                    acRate
-                    topicTags {
-                        name
-                        slug
-                    }
-                }
-                totalLength
-                hasMore
-            }
-        }
-        '''
+        return get(res, 'data.favoriteQuestionList')
 
-        variables = {
-            "favoriteSlug": company_slug,
-            "limit": limit,
-            "skip": skip,
-            "filtersV2": {
-                "filterCombineType": "ALL",
-                "statusFilter": {"questionStatuses": [], "operator": "IS"},
-                "difficultyFilter": {"difficulties": [], "operator": "IS"},
-                "topicFilter": {"topicSlugs": [], "operator": "IS"}
-            },
-            "sortBy": {"sortField": "FREQUENCY", "sortOrder": "DESCENDING"},
-            "searchKeyword": ""
-        }
+    def save_favourite_questions(self, questions: list) -> None:
+        with database.atomic(), BulkWriter() as writer:
+            for question in questions:
+                writer.add(
+                    FavouriteQuestion,
+                    slug=question['titleSlug'],
+                    status=question['status'],
+                    title=f'{question['questionFrontendId']}. {question['title']}',
+                )
 
-        query_params = {
-            "operationName": "favoriteQuestionList",
-            "variables": variables, 
-            "query": query, 
-        }
+    def save_top_questions(self, company_slug: str, questions: list) -> None:
+        with database.atomic(), BulkWriter() as writer:
+            for question in questions:
+                if not question['topicTags']:
+                    continue
+                writer.add(
+                    TopQuestion,
+                    title=f'{question['questionFrontendId']}. {question['title']}',
+                    slug=question['titleSlug'],
+                    status=question['status'],
+                    list_slug=company_slug,
+                    company=company_slug.split('-')[0],
+                    frequency=question['frequency'],
+                )
 
-        response = self.session.post(
-            GRAPHQL_URL,
-            data=json.dumps(query_params).encode('utf8'),
-            headers={"content-type": "application/json"})
-        
-        body = json.loads(response.content)
-        
-        # parse data
-        questions = get(body, 'data.favoriteQuestionList.questions')
-        for question in questions:
-            if not question['topicTags']:
-                continue
-            TopQuestion.replace(
-                title=f'{question['questionFrontendId']}. {question['title']}',
-                slug=question['titleSlug'],
-                status=question['status'],
-                company=company_slug[:-4].split('-')[0],
-                frequency=question['frequency'],
-            ).execute()
-        
-        print(f"🤖 Number of Company {len(questions)} problems")
-        return questions    
-            
-        
     def fetch_favourite_problems(self, contain_solution: bool):
-        response = self.session.get("https://leetcode.com/api/problems/all/")
-       
-        all_problems = json.loads(response.content.decode('utf-8'))
-        # filter AC problems
-        counter = 0
-        for item in all_problems['stat_status_pairs']:
-            id, slug = destructure(item['stat'], "question_id", "question__title_slug")
-            if FavouriteQuestion.get_or_none(FavouriteQuestion.slug == slug):    
-
-                # only update problem if not exists
-                if ProblemDetail.get_or_none(ProblemDetail.id == id) is None:
-                    counter += 1
-                    # fetch problem
-                    do(self.fetch_problem, args=[slug, True])
-                    # fetch solution
-                    if contain_solution:
-                        do(self.fetch_solution, args=[slug])
-                    
-                # always try to update submission
-                if contain_solution:
-                    do(self.fetch_submission, args=[slug])
-        print(f"🤖 Updated {counter} problems")
-
-    def fetch_accepted_problems(self): 
-        response = self.session.get("https://leetcode.com/api/problems/all/")
-       
-        all_problems = json.loads(response.content.decode('utf-8'))
+        self.crawl(self.plan_favourite_problems(contain_solution))
+
+    def plan_favourite_problems(self, contain_solution: bool) -> list:
+        self.sync_catalog()
+        # filter favourite problems
+        return self.plan_tasks(Catalog.slug.in_(FavouriteQuestion.select(FavouriteQuestion.slug)), contain_solution)
+
+    def fetch_accepted_problems(self):
+        self.crawl(self.plan_accepted_problems())
+
+    def plan_accepted_problems(self) -> list:
+        self.sync_catalog()
         # filter AC problems
-        counter = 0
-        for item in all_problems['stat_status_pairs']:
-            if item['status'] == 'ac':
-                id, slug = destructure(item['stat'], "question_id", "question__title_slug")
-
-                # only update problem if not exists
-                if ProblemDetail.get_or_none(ProblemDetail.id == id) is None:
-                    counter += 1
-                    # fetch problem
-                    do(self.fetch_problem, args=[slug, True])
-                    # fetch solution
-                    do(self.fetch_solution, args=[slug])
-                    
-                # always try to update submission
-                do(self.fetch_submission, args=[slug])
-        print(f"🤖 Updated {counter} problems")
+        return self.plan_tasks(Catalog.status == 'ac', True)
+
+    def plan_tasks(self, selection, contain_solution: bool) -> list:
+        """
+        Decides what to refetch for the catalog problems matching `selection`, in one
+        query: the detail when it is missing or its last sync is older than
+        [Sync] max_age_days; the submissions when LeetCode reports a status change
+        since the last sync, when one of the user's recent accepted submissions is
+        newer than the listed ones, or when [Sync] all_languages changed since they
+        were listed. Problems that are up to date get no task.
+
+        Edits to a statement or personal note show up in no listing, they are only
+        picked up once the detail is older than [Sync] max_age_days; a submission
+        sync does not reset that age, and refreshes the note on the way.
+        """
+        rows = (
+            Catalog.select(
+                Catalog.slug,
+                Catalog.status,
+                SyncState.status.alias('synced_status'),
+                SyncState.synced_at,
+                ProblemDetail.id.alias('problem_id'),
+                SubmissionIndex.last_id,
+                SubmissionIndex.all_languages,
+            )
+            .join(SyncState, JOIN.LEFT_OUTER, on=(SyncState.slug == Catalog.slug))
+            .join_from(Catalog, SubmissionIndex, JOIN.LEFT_OUTER, on=(SubmissionIndex.slug == Catalog.slug))
+            .join_from(Catalog, ProblemDetail, JOIN.LEFT_OUTER, on=(ProblemDetail.id == Catalog.id))
+            .where(selection)
+            .order_by(Catalog.id)
+            .dicts()
+        )
+
+        expired = datetime.now() - timedelta(days=parser.getint("Sync", "max_age_days"))
+        latest = self.latest_submissions() if contain_solution else {}
+        tasks = []
+        for row in rows:
+            is_stale = row['synced_at'] is None or row['synced_at'] < expired
+            fetch_detail = is_stale or row['problem_id'] is None
+            has_new_submission = row['slug'] in latest and (row['last_id'] is None or latest[row['slug']] > row['last_id'])
+            languages_changed = row['last_id'] is not None and row['all_languages'] != self.all_languages
+            fetch_submission = contain_solution and (
+                is_stale or row['synced_status'] != row['status'] or has_new_submission or languages_changed
+            )
+            if fetch_detail or fetch_submission:
+                tasks.append(CrawlTask(row['slug'], fetch_detail, fetch_submission, row['status']))
+
+        return tasks
+
+    def latest_submissions(self) -> dict:
+        """
+        Id of the newest recent accepted submission of the user per problem slug,
+        from one request listing the last [Sync] recent_submissions of them. Older
+        activity is left to the status change and max age checks.
+        """
+        if not self.username:
+            return {}
+
+        res = self.fetch({
+            'operationName': "recentAcSubmissions",
+            'variables': {'username': self.username, 'limit': parser.getint("Sync", "recent_submissions")},
+            'query': RECENT_AC_SUBMISSIONS_QUERY,
+        })
+        latest = {}
+        for sub in get(res, 'data.recentAcSubmissionList') or []:
+            latest[sub['titleSlug']] = max(latest.get(sub['titleSlug'], 0), int(sub['id']))
+        return latest
+
+    def sync_catalog(self) -> None:
+        """
+        Refreshes the local `Catalog` from the all-problems payload, parsing its
+        `stat_status_pairs` one item at a time as the response streams in.
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        chunks = (decoder.decode(chunk) for chunk in self.request_stream("GET", self.base_url + ALL_PROBLEMS_PATH, "catalog"))
+
+        count = 0
+        with database.atomic(), BulkWriter() as writer:
+            Catalog.delete().execute()
+            for item in iter_json_array(chunks, 'stat_status_pairs'):
+                id, display_id, title, slug = destructure(
+                    item['stat'], "question_id", "frontend_question_id", "question__title", "question__title_slug"
+                )
+                writer.add(
+                    Catalog,
+                    id=id,
+                    display_id=display_id,
+                    title=title,
+                    slug=slug,
+                    level=get(item, 'difficulty.level'),
+                    status=item['status'],
+                    paid_only=item['paid_only'],
+                    is_favor=item['is_favor'],
+                )
+                count += 1
+
+        # the parser stops at the end of the array, the rest of the body still has to
+        # be read for the response cache to store it
+        for _ in chunks:
+            pass
+
+        print(f"🤖 Catalog has {count} problems")
+
+    def crawl(self, tasks: list) -> None:
+        """
+        Queues every `CrawlTask` in the persistent job queue and drains it,
+        `batch_size` slugs per GraphQL request. Jobs left over by an interrupted
+        crawl are picked up again.
+
+        With more than one worker the batches are fetched concurrently; the shared
+        rate limiter, not the number of workers, bounds the request volume. On
+        Ctrl-C the workers stop claiming jobs, and the ones in flight are resumed
+        by the next run.
+        """
+        queue = self.open_queue(tasks)
+
+        if self.workers <= 1:
+            self.drain(queue)
+        else:
+            stop = Event()
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+            try:
+                futures = [executor.submit(self.drain, queue, stop) for _ in range(self.workers)]
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # the interrupt only reaches the main thread, the workers would drain the whole queue
+                stop.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            executor.shutdown()
+
+        self.close_queue(queue, tasks)
+
+    def open_queue(self, tasks: list) -> JobQueue:
+        queue = JobQueue()
+        recovered = queue.recover()
+        if recovered:
+            print(f"🤖 Resuming {recovered} interrupted jobs")
+        queue.enqueue(tasks)
+        return queue
+
+    def close_queue(self, queue: JobQueue, tasks: list) -> None:
+        stats = self.limiter.stats()
+        print(
+            f"🤖 Request rate {stats['rate']:.2f}/s, latency {stats['latency']:.2f}s, "
+            f"errors {stats['error_rate']:.0%}, throttled {stats['throttle_rate']:.0%}"
+        )
+
+        failed = queue.finish()
+        if failed:
+            print(f"❌ Failed to sync {len(failed)} problems: {', '.join(failed)}")
+        print(f"🤖 Updated {sum(1 for task in tasks if task.fetch_detail)} problems")
+
+    def drain(self, queue: JobQueue, stop: Event = None) -> None:
+        batch_size = parser.getint("Crawler", "batch_size")
+        while stop is None or not stop.is_set():
+            batch, wait = queue.next_batch(batch_size)
+            if wait is None:
+                return
+            if not batch:
+                time.sleep(wait)
+                continue
+
+            for tasks in queue.attempts(batch):
+                error = None
+                try:
+                    self.sync_batch(tasks)
+                except Exception as e:
+                    error = e
+                if queue.settle(batch, tasks, error):
+                    break
+
+    def sync_batch(self, tasks: list) -> None:
+        print(f"🤖 Fetching {len(tasks)} problems at {self.limiter.rate:.2f} req/s: {', '.join(task.slug for task in tasks)}...")
+
+        data = self.batch_data(self.fetch(self.build_batch_query(tasks)))
+        submissions = {
+            task.slug: self.list_new_submissions(task.slug, get(data, f'l{i}'))
+            for i, task in enumerate(tasks) if task.contain_solution
+        }
+        codes = {
+            sub['id']: self.fetch_submission_details(sub['id'])
+            for subs in submissions.values() for sub in self.pick_submissions(subs)
+        }
+        self.save_batch(tasks, data, submissions, codes)
+        self.media.download(self.batch_images(tasks, data))
+
+    def batch_images(self, tasks: list, data: dict) -> list:
+        """Images of the problem statements of a batch."""
+        return [
+            url for i, task in enumerate(tasks) if task.fetch_detail
+            for url in image_urls((data.get(f'q{i}') or {}).get('content'), self.base_url)
+        ]
+
+    def batch_data(self, res: dict) -> dict:
+        data = get(res, 'data')
+        if data is None:
+            raise Exception(f"Batch query failed: {get(res, 'errors')}")
+        return data
+
+    def save_batch(self, tasks: list, data: dict, submissions: dict, codes: dict) -> None:
+        """
+        Splits the aliased response of a batch back into per-problem writes, with
+        the new `submissions` listed per slug and the downloaded `codes` by submission id.
+        """
+        # problems, notes, tags and submissions of the whole batch are written in one
+        # transaction, the sync state only once they are on disk. It takes the write
+        # lock up front: a read transaction upgraded to a write fails at once, without
+        # waiting, while another worker writes
+        synced = []
+        with database.atomic('IMMEDIATE'), BulkWriter() as writer:
+            for i, (slug, fetch_detail, contain_solution, status) in enumerate(tasks):
+                hashes = {}
+                question = data.get(f'q{i}')
+                if fetch_detail:
+                    if question is None:
+                        print(f"❌ Problem could not be found: {slug}")
+                        continue
+
+                    hashes['content_hash'] = self.save_problem(slug, question, True, writer)
+                if contain_solution and question is not None:
+                    hashes['note_hash'] = self.save_note(slug, question)
+
+                if slug in submissions:
+                    self.store_submissions(slug, submissions[slug], codes, writer)
+
+                synced.append((slug, status, hashes))
+
+        for slug, status, hashes in synced:
+            self.mark_synced(slug, status, **hashes)
+            if slug in submissions:
+                self.mark_submissions_listed(slug, submissions[slug])
+
+    def mark_synced(self, slug: str, status: str, content_hash: str = None, note_hash: str = None) -> None:
+        """
+        Records the sync state of `slug`. Its age only restarts when the detail was
+        fetched (`content_hash`), a sync of the submissions alone leaves it, so a
+        problem with frequent new submissions still reaches [Sync] max_age_days.
+        """
+        fields = {SyncState.status: status}
+        if content_hash:
+            fields[SyncState.content_hash] = content_hash
+            fields[SyncState.synced_at] = datetime.now()
+        if note_hash:
+            fields[SyncState.note_hash] = note_hash
+
+        SyncState.insert({SyncState.slug: slug, **fields}).on_conflict(
+            conflict_target=[SyncState.slug],
+            update=fields,
+        ).execute()
+
+    def catalog_status(self, slug: str) -> str:
+        """Status the catalog reports for `slug`, recorded with its sync state so the next plan sees no change."""
+        return Catalog.select(Catalog.status).where(Catalog.slug == slug).scalar()
+
+    def build_batch_query(self, tasks: list) -> dict:
+        """
+        Builds one aliased query for a batch of tasks: `q{i}` selects the detail
+        and note of the i-th slug, `l{i}` the first page of its submissions. A
+        task syncing only the submissions still selects the note, which is usually
+        edited along with a new submission.
+        """
+        page_size = parser.getint("Crawler", "submission_page_size")
+        params, fields, variables = [], [], {}
+        for i, (slug, fetch_detail, contain_solution, _) in enumerate(tasks):
+            params.append(f'$s{i}: String!')
+            variables[f's{i}'] = slug
+
+            selection = (QUESTION_DETAIL_FIELDS if fetch_detail else '') + (QUESTION_NOTE_FIELDS if contain_solution else '')
+            if selection:
+                fields.append(f'q{i}: question(titleSlug: $s{i}) {{{selection}}}')
+            if contain_solution:
+                fields.append(
+                    f'l{i}: submissionList(offset: 0, limit: {page_size}, lastKey: "", questionSlug: $s{i}) {{{SUBMISSION_LIST_FIELDS}}}'
+                )
+
+        query = "query batchProblems(" + ", ".join(params) + ") {\n" + "\n".join(fields) + "\n}"
+        return {
+            'operationName': "batchProblems",
+            'variables': variables,
+            'query': query,
+        }
 
     def fetch_problem(self, slug: str, accepted: bool=False) -> None:
         print(f"🤖 Fetching problem: https://leetcode.com/problem/{slug}/...")
-        
-        query_params = {
+
+        res = self.fetch(self.problem_query(slug))
+
+        # parse data
+        question = get(res, 'data.question')
+        self.mark_synced(slug, self.catalog_status(slug), self.save_problem(slug, question, accepted))
+        self.media.download(image_urls(question['content'], self.base_url))
+
+    def problem_query(self, slug: str) -> dict:
+        return {
             'operationName': "getQuestionDetail",
             'variables': {'titleSlug': slug},
-            'query': '''query getQuestionDetail($titleSlug: String!) {
-                question(titleSlug: $titleSlug) {
-                    questionId
-                    questionFrontendId
-                    questionTitle
-                    questionTitleSlug
-                    content
-                    difficulty
-                    stats
-                    similarQuestions
-                    categoryTitle
-                    topicTags {
-                        name
-                        slug
-                    }
-                }
-            }'''
+            'query': f'''query getQuestionDetail($titleSlug: String!) {{
+                question(titleSlug: $titleSlug) {{{QUESTION_DETAIL_FIELDS}}}
+            }}'''
         }
-        
-        res = self.fetch(query_params)
 
-        # parse data
-        question = get(res, 'data.question')
+    def save_problem(self, slug: str, question: dict, accepted: bool=False, writer: BulkWriter = None) -> str:
+        detail_hash = content_hash(
+            question['questionFrontendId'], question["questionTitle"], question["difficulty"],
+            question['content'], question['topicTags'], accepted,
+        )
+        state = SyncState.get_or_none(SyncState.slug == slug)
+        if state and state.content_hash == detail_hash and ProblemDetail.get_or_none(ProblemDetail.slug == slug):
+            print(f"🤖 Problem is unchanged: {slug}")
+            return detail_hash
 
-        ProblemDetail.replace(
+        # keep the personal note fields of an existing problem, they are synced by `save_note`
+        ProblemDetail.insert(
             id=question['questionId'], 
             display_id=question['questionFrontendId'],
             title=question["questionTitle"],
@@ -326,65 +747,50 @@ class LeetCodeCrawler:
             edgecases='',
             clarify_questions='',
             note='',
+        ).on_conflict(
+            conflict_target=[ProblemDetail.id],
+            preserve=[
+                ProblemDetail.display_id, ProblemDetail.title, ProblemDetail.level,
+                ProblemDetail.slug, ProblemDetail.description, ProblemDetail.accepted,
+            ],
+            update={ProblemDetail.update_time: datetime.now()},
         ).execute()
 
-        for item in question['topicTags']:
-            if Tag.get_or_none(Tag.slug == item['slug']) is None:
-                Tag.replace(
-                    name=item['name'],
-                    slug=item['slug']
-                ).execute()
+        with writer or BulkWriter() as writer:
+            for item in question['topicTags']:
+                writer.add(Tag, name=item['name'], slug=item['slug'])
+                writer.add(ProblemTag, problem=question['questionId'], tag=item['slug'])
 
-            ProblemTag.replace(
-                problem=question['questionId'],
-                tag=item['slug']
-            ).execute()
-        
-        random_wait(10, 15)
+        return detail_hash
 
     def fetch_solution(self, slug: str) -> None:
         print(f"🤖 Fetching solution for problem: {slug}")
-        
-        query_params = {
+
+        res = self.fetch(self.note_query(slug))
+
+        # parse data
+        self.save_note(slug, get(res, "data.question"))
+
+    def note_query(self, slug: str) -> dict:
+        return {
             "operationName": "QuestionNote",
             "variables": {"titleSlug": slug},
-            "query": '''
-            query QuestionNote($titleSlug: String!) {
-                question(titleSlug: $titleSlug) {
-                    questionId
-                    article
-                    note
-                    solution {
-                      id
-                      content
-                      contentTypeId
-                      canSeeDetail
-                      paidOnly
-                      rating {
-                        id
-                        count
-                        average
-                        userRating {
-                          score
-                          __typename
-                        }
-                        __typename
-                      }
-                      __typename
-                    }
-                    __typename
-                }
-            }
+            "query": f'''
+            query QuestionNote($titleSlug: String!) {{
+                question(titleSlug: $titleSlug) {{{QUESTION_NOTE_FIELDS}}}
+            }}
             '''
         }
-        
-        res = self.fetch(query_params)
 
-        # parse data
-        solution = get(res, "data.question")
+    def save_note(self, slug: str, solution: dict) -> str:
         is_solution_existed = solution['solution'] is not None and solution['solution']['paidOnly'] is False
         
         if is_solution_existed:
+            note_hash = content_hash(solution['note'])
+            state = SyncState.get_or_none(SyncState.slug == slug)
+            if state and state.note_hash == note_hash:
+                return note_hash
+
             data = self.decompose_note(solution['note'])
             ProblemDetail.update({
                  ProblemDetail.approaches:data['approaches'],
@@ -399,8 +805,8 @@ class LeetCodeCrawler:
             #     url=f"https://leetcode.com/articles/{slug}/",
             #     content=solution['solution']['content']
             # ).execute()
-        
-        random_wait(10, 15)
+
+            return note_hash
 
 
     def decompose_note(self, input_str: str) -> dict:
@@ -461,68 +867,133 @@ class LeetCodeCrawler:
 
     def fetch_submission(self, slug: str) -> None:
         print(f"🖍 Fetching submission for problem: {slug}")
-        
-        query_params = {
+
+        submissions = self.list_new_submissions(slug)
+        codes = {sub['id']: self.fetch_submission_details(sub['id']) for sub in self.pick_submissions(submissions)}
+
+        # parse data
+        self.store_submissions(slug, submissions, codes)
+        self.mark_submissions_listed(slug, submissions)
+
+    def submission_list_query(self, slug: str, offset: int = 0, last_key: str = '') -> dict:
+        return {
             'operationName': "Submissions",
             'variables': {
-                "offset": 0, 
-                "limit": 20, 
-                "lastKey": '', 
+                "offset": offset, 
+                "limit": parser.getint("Crawler", "submission_page_size"), 
+                "lastKey": last_key, 
                 "questionSlug": slug
             },
-            'query': '''query Submissions($offset: Int!, $limit: Int!, $lastKey: String, $questionSlug: String!) {
-                submissionList(offset: $offset, limit: $limit, lastKey: $lastKey, questionSlug: $questionSlug) {
-                    lastKey
-                    hasNext
-                    submissions {
-                        id
-                        statusDisplay
-                        lang
-                        runtime
-                        timestamp
-                        url
-                        isPending
-                        __typename
-                    }
-                    __typename
-                }
-            }'''
+            'query': f'''query Submissions($offset: Int!, $limit: Int!, $lastKey: String, $questionSlug: String!) {{
+                submissionList(offset: $offset, limit: $limit, lastKey: $lastKey, questionSlug: $questionSlug) {{{SUBMISSION_LIST_FIELDS}}}
+            }}'''
         }
-        
-        res = self.fetch(query_params)
 
-        # parse data
-        submissions = get(res, "data.submissionList.submissions")
-        if len(submissions) > 0:
-            for sub in submissions:
-                if Submission.get_or_none(Submission.id == sub['id']) is not None:
-                    continue
+    def list_new_submissions(self, slug: str, page: dict = None) -> list:
+        """
+        Lists the submissions of `slug` newer than the last listed one, newest first.
+
+        The next page is only requested (with `lastKey`) while every submission on
+        the current one is new, so a resync costs a single page unless there was
+        more activity than fits on it. `page` is the first page when a batch query
+        already returned it.
+        """
+        last_id = self.last_listed_submission(slug)
+        submissions = []
+        query = self.next_submission_query(slug, submissions, page, last_id)
+        while query is not None:
+            page = get(self.fetch(query), 'data.submissionList') or {}
+            query = self.next_submission_query(slug, submissions, page, last_id)
+        return submissions
+
+    def next_submission_query(self, slug: str, submissions: list, page: dict, last_id: int) -> dict:
+        """
+        Appends the submissions of `page` newer than `last_id` to `submissions`, and
+        returns the query of the next page when it may still hold some worth
+        listing, None otherwise. Without a `page`, returns the query of the first one.
+        """
+        if page is None:
+            return self.submission_list_query(slug)
+
+        items = page.get('submissions') or []
+        new = [sub for sub in items if last_id is None or int(sub['id']) > last_id]
+        submissions += new
+        if not page.get('hasNext') or not items or len(new) < len(items):
+            return None
+        # a first sync only needs the newest accepted submission, not the whole history
+        if last_id is None and not self.all_languages and self.pick_submissions(submissions):
+            return None
+        return self.submission_list_query(slug, len(submissions), page['lastKey'])
+
+    def last_listed_submission(self, slug: str) -> int:
+        """
+        Id of the newest submission listed before, the newest stored one for problems
+        synced before the index existed. None when the whole history has to be listed
+        again, after [Sync] all_languages changed.
+        """
+        index = SubmissionIndex.get_or_none(SubmissionIndex.slug == slug)
+        if index is not None:
+            return index.last_id if index.all_languages == self.all_languages else None
+        if self.all_languages:
+            return None
+        return Submission.select(fn.MAX(Submission.id)).where(Submission.slug == slug).scalar()
+
+    def pick_submissions(self, submissions: list) -> list:
+        """
+        Picks the new accepted submissions whose code is worth downloading: the
+        newest one, or the newest one of every language with `all_languages`.
+        """
+        picked, languages = [], set()
+        for sub in submissions:
+            if sub['statusDisplay'] != 'Accepted' or sub['lang'] in languages:
+                continue
+            picked.append(sub)
+            languages.add(sub['lang'])
+            if not self.all_languages:
+                break
+        return picked
+
+    def store_submissions(self, slug: str, submissions: list, codes: dict, writer: BulkWriter = None) -> None:
+        picked = self.pick_submissions(submissions)
+        with writer or BulkWriter() as writer:
+            for sub in picked:
+                code = codes.get(sub['id'])
+                if not code:
+                    raise Exception(f"Cannot get submission code for problem: {slug}")
+
+                writer.add(
+                    Submission,
+                    id=sub['id'],
+                    slug=slug,
+                    language=sub['lang'],
+                    submitted_date=datetime.fromtimestamp(int(sub['timestamp'])),
+                    source=code
+                )
+
+        if picked:
+            print(f"✅ Successfully saved {len(picked)} accepted submissions for: {slug}")
+
+    def mark_submissions_listed(self, slug: str, submissions: list) -> None:
+        if submissions:
+            SubmissionIndex.replace(
+                slug=slug,
+                last_id=max(int(sub['id']) for sub in submissions),
+                all_languages=self.all_languages,
+                synced_at=datetime.now(),
+            ).execute()
+        else:
+            SubmissionIndex.update(all_languages=self.all_languages, synced_at=datetime.now()).where(
+                SubmissionIndex.slug == slug
+            ).execute()
 
-                if sub['statusDisplay'] == 'Accepted':
-                    id = sub['id']
-                        
-                    code = self.fetch_submission_details(id)
-                    
-                    if code:
-                        Submission.insert(
-                            id=sub['id'],
-                            slug=slug,
-                            language=sub['lang'],
-                            submitted_date=datetime.fromtimestamp(int(sub['timestamp'])),
-                            source=code
-                        ).execute()
-                    else:
-                        raise Exception(f"Cannot get submission code for problem: {slug}")
-                    
-                    print(f"✅ Successfully saved accepted submission for: {slug}")
-                    break  # Stop after saving the first accepted submission
-        
-        random_wait(10, 15)
-        
     def fetch_submission_details(self, submission_id):
         print(f"🖍 Fetching submission details code for problem: {submission_id}")
-        
-        query_params = {
+
+        res = self.fetch(self.submission_details_query(submission_id))
+        return get(res, "data.submissionDetails.code")
+
+    def submission_details_query(self, submission_id) -> dict:
+        return {
             'operationName': "submissionDetails",
             'variables': {
                 "submissionId": submission_id, 
@@ -535,14 +1006,66 @@ class LeetCodeCrawler:
             }'''
         }
 
-        res = self.fetch(query_params)
-        return get(res, "data.submissionDetails.code")
-
     def fetch(self, query_params):
-        response = self.session.post(
-            GRAPHQL_URL,
-            data=json.dumps(query_params).encode('utf8'),
-            headers={"content-type": "application/json"},
-        )
+        content = self.request("POST", self.base_url + GRAPHQL_PATH, query_params['operationName'], query_params)
+
+        return json.loads(content)
+
+    def request_stream(self, method: str, url: str, operation: str, chunk_size: int = 1 << 16):
+        """
+        Like `request`, but yields the body in chunks as it arrives (or is read from
+        the cache), so large payloads are never held in memory whole.
+        """
+        lookup = self.cache.lookup(operation, method, url, None)
+        if lookup.is_fresh():
+            yield from lookup.cached.iter_body(chunk_size)
+            return
+
+        with self.send(method, url, headers=lookup.conditional_headers(), stream=True) as response:
+            if lookup.not_modified(response.status_code):
+                yield from lookup.cached.iter_body(chunk_size)
+                return
+
+            response.raise_for_status()
+            chunks = response.iter_content(chunk_size)
+            if lookup.ttl > 0:
+                chunks = self.cache.put_stream(lookup.key, chunks, response.headers)
+            yield from chunks
+
+    def request(self, method: str, url: str, operation: str, payload: dict = None) -> bytes:
+        """
+        Sends a request under the shared rate limit. Responses are served from the
+        on-disk cache while fresh for the TTL of `operation`, and revalidated with
+        If-None-Match/If-Modified-Since once stale.
+        """
+        lookup = self.cache.lookup(operation, method, url, payload)
+        if lookup.is_fresh():
+            return lookup.cached.body
+
+        headers = lookup.conditional_headers()
+        data = None
+        if payload is not None:
+            headers["content-type"] = "application/json"
+            data = json.dumps(payload).encode('utf8')
+
+        response = self.send(method, url, data=data, headers=headers)
+        return lookup.resolve(response.status_code, response.content, response.headers)
+
+    def send(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends one request under the adaptive rate limit and reports its latency and
+        status back to the limiter. Throttled (429) and server error (5xx) responses
+        raise, so the crawl retries them later.
+        """
+        self.limiter.acquire()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self.limiter.record(None, None)
+            raise
 
-        return json.loads(response.content)
\ No newline at end of file
+        self.limiter.record(response.elapsed.total_seconds(), response.status_code, response.headers.get('Retry-After'))
+        if response.status_code == 429 or response.status_code >= 500:
+            response.close()
+            response.raise_for_status()
+        return response
\ No newline at end of file
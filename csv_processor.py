@@ -1,17 +1,18 @@
 import csv
 
-from database import LeetCodeTrack
+from database import BulkWriter, LeetCodeTrack, database
 
 file_name = 'leetcode-tracker.csv'
 
 class CSVProcessor:
 
     def sync_leetcode_track(self):
-        with open(file_name, newline='') as csvfile:
+        with open(file_name, newline='') as csvfile, database.atomic(), BulkWriter() as writer:
             reader = csv.DictReader(csvfile)
             for row in reader:
-                LeetCodeTrack.replace(
+                writer.add(
+                    LeetCodeTrack,
                     title=row['Problem'],
                     status='TO_DO' if not row['Side Note'] else 'REVISIT'
-                ).execute()
+                )
                 
\ No newline at end of file
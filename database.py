@@ -3,6 +3,8 @@ import logging
 import pathlib
 
 from peewee import *
+from peewee import chunked
+from playhouse.sqlite_ext import FTS5Model, SearchField
 
 
 from utils import parser
@@ -17,7 +19,20 @@ if parser.get("DB", "debug") == "True":
 directory = parser.get("DB", "path")
 p = pathlib.Path(directory)
 p.mkdir(parents=True, exist_ok=True)
-database = SqliteDatabase(directory + "/LeetCode.sqlite")
+# the write-ahead log lets the renderer read while the crawler writes, and with
+# synchronous=normal a commit no longer waits for an fsync
+database = SqliteDatabase(directory + "/LeetCode.sqlite", pragmas={
+    'journal_mode': parser.get("DB", "journal_mode"),
+    'synchronous': parser.get("DB", "synchronous"),
+    'cache_size': parser.getint("DB", "cache_size"),
+    'mmap_size': parser.getint("DB", "mmap_size"),
+    'temp_store': 'memory',
+    # rows replaced by INSERT OR REPLACE fire the delete triggers keeping the search index in sync
+    'recursive_triggers': 1,
+})
+
+# SQLite's default limit of bound variables in one statement
+SQLITE_MAX_VARIABLES = 999
 
 
 # data models
@@ -30,8 +45,9 @@ class BaseModel(Model):
 # --------------------------
 class ProblemDetail(BaseModel):
     display_id = IntegerField(unique=True)
-    level = CharField()
-    title = CharField()
+    # indexed for the deck selectors, see `renderer.problem_selection`
+    level = CharField(index=True)
+    title = CharField(index=True)
     slug = CharField(unique=True)
     description = TextField()
     accepted = BooleanField()
@@ -64,6 +80,20 @@ class ProblemDetail(BaseModel):
             )
         )
 
+# --------------------------
+# Catalog of every LeetCode problem
+# --------------------------
+class Catalog(BaseModel):
+    id = IntegerField(primary_key=True)
+    display_id = IntegerField()
+    title = CharField()
+    slug = CharField(unique=True)
+    level = IntegerField()
+    # 'ac', 'notac' or None when never attempted
+    status = CharField(null=True, index=True)
+    paid_only = BooleanField()
+    is_favor = BooleanField()
+
 # --------------------------
 # Submissions and Solutions
 # --------------------------
@@ -97,13 +127,15 @@ class Tag(BaseModel):
 
 
 class ProblemTag(BaseModel):
-    problem = ForeignKeyField(ProblemDetail)
-    tag = ForeignKeyField(Tag)
+    problem = ForeignKeyField(ProblemDetail, index=False)
+    tag = ForeignKeyField(Tag, index=False)
 
     class Meta:
         indexes = (
             # Specify a unique multi-column index on from/to-user.
             (('problem', 'tag'), True),
+            # covers looking problems up by tag without touching the table
+            (('tag', 'problem'), False),
         )
 
 
@@ -112,7 +144,7 @@ class ProblemTag(BaseModel):
 # --------------------------
 class FavouriteQuestion(BaseModel):
     title = TextField()
-    slug = ForeignKeyField(ProblemDetail, 'slug', backref='favouritequestions')
+    slug = ForeignKeyField(ProblemDetail, 'slug', backref='favouritequestions', unique=True)
     status = CharField()
     title = TextField()
     
@@ -131,19 +163,254 @@ class TopQuestion(BaseModel):
     title = CharField()
     slug = ForeignKeyField(ProblemDetail, 'slug', backref='topquestions')
     status = CharField(null = False)
+    # the company list the question was synced from, e.g. amazon-three-months
+    list_slug = CharField()
     company = CharField()
     frequency = FloatField()
 
+    class Meta:
+        indexes = (
+            (('list_slug', 'slug'), True),
+            # a company's questions by frequency
+            (('company', 'frequency'), False),
+        )
+
 
 class LeetCodeTrack(BaseModel):
-    title = CharField()
+    title = CharField(unique=True)
     status = CharField()
     # simlar_questions = 
 
 
+# --------------------------
+# Incremental Sync State
+# --------------------------
+class SyncState(BaseModel):
+    slug = CharField(primary_key=True)
+    # hashes of the last fetched problem detail and personal note
+    content_hash = CharField(null=True)
+    note_hash = CharField(null=True)
+    # problem status ('ac', 'notac' or None) reported by LeetCode at the last sync
+    status = CharField(null=True)
+    synced_at = DateTimeField(default=datetime.now)
+
+
+class SubmissionIndex(BaseModel):
+    slug = CharField(primary_key=True)
+    # newest submission id already listed for the problem, resyncs only page through newer ones
+    last_id = IntegerField()
+    # [Sync] all_languages when it was listed, the history is listed again once it changes
+    all_languages = BooleanField(default=False)
+    synced_at = DateTimeField(default=datetime.now)
+
+
+# --------------------------
+# Resumable Crawl Queue
+# --------------------------
+class CrawlJob(BaseModel):
+    slug = CharField(primary_key=True)
+    fetch_detail = BooleanField()
+    contain_solution = BooleanField()
+    # catalog status handed over to the sync state once the job is done
+    status = CharField(null=True)
+    # pending | in_flight | done | failed
+    state = CharField(default='pending', index=True)
+    attempts = IntegerField(default=0)
+    next_attempt_at = DateTimeField(default=datetime.now)
+    last_error = TextField(null=True)
+    updated_at = DateTimeField(default=datetime.now)
+
+
+# --------------------------
+# Rendered HTML Cache
+# --------------------------
+class RenderCache(BaseModel):
+    # hash of source + language + renderer version
+    key = CharField(primary_key=True)
+    html = TextField()
+    used_at = DateTimeField(default=datetime.now)
+
+
+# --------------------------
+# Media
+# --------------------------
+class Media(BaseModel):
+    # remote image and the content-addressed file of the media store it was downloaded to
+    url = CharField(primary_key=True)
+    filename = CharField()
+    fetched_at = DateTimeField(default=datetime.now)
+
+
+# --------------------------
+# Exported Notes
+# --------------------------
+class ExportState(BaseModel):
+    # note guid and a checksum of everything the note was rendered from
+    guid = CharField(primary_key=True)
+    checksum = CharField()
+    exported_at = DateTimeField(default=datetime.now)
+
+
+# --------------------------
+# Full-Text Search
+# --------------------------
+class ProblemSearch(FTS5Model):
+    """Search index over the problem statements and personal notes, its rows live in `problemdetail`."""
+    title = SearchField()
+    description = SearchField()
+    clarify_questions = SearchField()
+    approaches = SearchField()
+    mistakes = SearchField()
+    edgecases = SearchField()
+    note = SearchField()
+
+    class Meta:
+        database = database
+        table_name = 'problem_search'
+        options = {'content': 'problemdetail', 'content_rowid': 'id', 'tokenize': 'porter unicode61'}
+
+
+class SubmissionSearch(FTS5Model):
+    """Search index over the accepted submissions, its rows live in `submission`."""
+    source = SearchField()
+    language = SearchField(unindexed=True)
+
+    class Meta:
+        database = database
+        table_name = 'submission_search'
+        options = {'content': 'submission', 'content_rowid': 'id', 'tokenize': 'unicode61'}
+
+
+def search_triggers(model) -> list:
+    """Triggers mirroring every insert, update and delete of the content table into its search index."""
+    index, content = model._meta.table_name, model._meta.options['content']
+    columns = [field.column_name for field in model._meta.sorted_fields if isinstance(field, SearchField)]
+    names = ", ".join(columns)
+    new = ", ".join(f"new.{column}" for column in columns)
+    old = ", ".join(f"old.{column}" for column in columns)
+
+    insert = f"INSERT INTO {index}(rowid, {names}) VALUES (new.id, {new});"
+    delete = f"INSERT INTO {index}({index}, rowid, {names}) VALUES ('delete', old.id, {old});"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {index}_ai AFTER INSERT ON {content} BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_ad AFTER DELETE ON {content} BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_au AFTER UPDATE OF {names} ON {content} BEGIN {delete} {insert} END",
+    ]
+
+
+def create_search_indexes():
+    """Creates the search indexes and their triggers, indexing the rows already stored the first time."""
+    for model in [ProblemSearch, SubmissionSearch]:
+        if not model.table_exists():
+            model.create_table()
+            model.rebuild()
+        for sql in search_triggers(model):
+            database.execute_sql(sql)
+
+
+class BulkWriter:
+    """
+    Buffers rows per model and writes them with multi-row `INSERT OR REPLACE`
+    statements inside one transaction, every `batch_size` rows and on exit.
+
+    Nested `with writer:` blocks share the buffer, only the outermost one flushes.
+    When the block raises, the rows still buffered are dropped instead of written.
+    """
+
+    def __init__(self, batch_size: int = None):
+        self.batch_size = batch_size or parser.getint("DB", "batch_size")
+        self.rows = {}
+        self.size = 0
+        self.depth = 0
+
+    def add(self, model, **row) -> None:
+        self.rows.setdefault(model, []).append(row)
+        self.size += 1
+        if self.size >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        rows, self.rows, self.size = self.rows, {}, 0
+        if not rows:
+            return
+
+        with database.atomic():
+            for model, items in rows.items():
+                for batch in chunked(items, max(1, SQLITE_MAX_VARIABLES // len(items[0]))):
+                    model.insert_many(batch).on_conflict_replace().execute()
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            if exc_type is not None:
+                self.rows, self.size = {}, 0
+                return
+            self.flush()
+
+
+# --------------------------
+# Migrations
+# --------------------------
+def migrate_natural_keys(tables: set) -> None:
+    """
+    Drops the duplicates earlier syncs piled up in the personal lists, keeping the
+    newest row per natural key, so the unique indexes can be built. Also drops the
+    single column indexes superseded by the composite ones.
+    """
+    for model, fields in [
+        (FavouriteQuestion, [FavouriteQuestion.slug]),
+        (TopQuestion, [TopQuestion.company, TopQuestion.slug]),
+        (LeetCodeTrack, [LeetCodeTrack.title]),
+    ]:
+        if model._meta.table_name in tables:
+            newest = model.select(fn.MAX(model.id)).group_by(*fields)
+            model.delete().where(model.id.not_in(newest)).execute()
+
+    for index in ['favouritequestion_slug_id', 'problemtag_problem_id', 'problemtag_tag_id']:
+        database.execute_sql(f'DROP INDEX IF EXISTS "{index}"')
+
+
+def add_submission_index_languages(tables: set) -> None:
+    """Records which [Sync] all_languages setting each submission index was listed with."""
+    if SubmissionIndex._meta.table_name in tables:
+        database.execute_sql('ALTER TABLE "submissionindex" ADD COLUMN "all_languages" INTEGER NOT NULL DEFAULT 0')
+
+
+def add_top_question_lists(tables: set) -> None:
+    """
+    Keys the top questions by company list instead of company. The rows keyed by
+    company merged the periods of a company together and cannot be told apart,
+    they are dropped and the next top questions sync fills the lists again.
+    """
+    database.execute_sql('DROP INDEX IF EXISTS "topquestion_company_slug"')
+    if TopQuestion._meta.table_name in tables:
+        database.execute_sql('DELETE FROM "topquestion"')
+        database.execute_sql('ALTER TABLE "topquestion" ADD COLUMN "list_slug" VARCHAR(255) NOT NULL DEFAULT \'\'')
+
+
+# migration i upgrades a database from user_version i to i + 1
+MIGRATIONS = [migrate_natural_keys, add_submission_index_languages, add_top_question_lists]
+
+
+def migrate():
+    """Brings a database created by an older version up to date, before `create_tables` adds what is missing."""
+    version = database.pragma('user_version')
+    tables = set(database.get_tables())
+    with database.atomic():
+        for target, migration in enumerate(MIGRATIONS[version:], version + 1):
+            migration(tables)
+            database.pragma('user_version', target)
+
+
 def create_tables():
     with database:
-        database.create_tables([ProblemDetail, Solution, Submission, Tag, ProblemTag, FavouriteQuestion, TopQuestion, LeetCodeTrack])
+        migrate()
+        database.create_tables([ProblemDetail, Catalog, Solution, Submission, Tag, ProblemTag, FavouriteQuestion, TopQuestion, LeetCodeTrack, SyncState, SubmissionIndex, RenderCache, Media, ExportState, CrawlJob])
+        create_search_indexes()
 
 
 if __name__ == '__main__':
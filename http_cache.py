@@ -0,0 +1,235 @@
+import json
+import os
+import pathlib
+from threading import Lock, get_ident
+import time
+
+from utils import content_hash, parser
+
+
+class CachedResponse:
+    def __init__(self, body_path: pathlib.Path, meta: dict):
+        self.body_path = body_path
+        self.stored_at = meta['stored_at']
+        self.etag = meta.get('etag')
+        self.last_modified = meta.get('last_modified')
+
+    @property
+    def body(self) -> bytes:
+        with open(self.body_path, 'rb') as f:
+            return f.read()
+
+    def iter_body(self, chunk_size: int = 1 << 16):
+        with open(self.body_path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    def is_fresh(self, ttl: int) -> bool:
+        return time.time() - self.stored_at < ttl
+
+    def conditional_headers(self) -> dict:
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class CacheLookup:
+    """
+    One request as seen by the cache, from the lookup before it is sent to
+    storing its response, whatever client sends it.
+    """
+
+    def __init__(self, cache: 'ResponseCache', operation: str, key: str):
+        self.cache = cache
+        self.key = key
+        self.ttl = cache.ttl(operation)
+        self.cached = cache.get(key) if self.ttl > 0 else None
+
+    def is_fresh(self) -> bool:
+        return self.cached is not None and self.cached.is_fresh(self.ttl)
+
+    def conditional_headers(self) -> dict:
+        return self.cached.conditional_headers() if self.cached else {}
+
+    def not_modified(self, status_code: int) -> bool:
+        """Whether the response revalidated the cached entry, which is then fresh again."""
+        if self.cached is None or status_code != 304:
+            return False
+        self.cache.revalidate(self.key)
+        return True
+
+    def resolve(self, status_code: int, body: bytes, headers) -> bytes:
+        """The body a response stands for: the cached one when it was not modified, its own otherwise, stored when cacheable."""
+        if self.not_modified(status_code):
+            return self.cached.body
+
+        # never cache failures, including GraphQL responses carrying a top-level "errors" key
+        if self.ttl > 0 and 200 <= status_code < 300 and b'"errors":' not in body:
+            self.cache.put(self.key, body, headers)
+        return body
+
+
+class ResponseCache:
+    """
+    On-disk cache of HTTP response bodies, one `<key>.body`/`<key>.json` pair per request.
+
+    Entries stay fresh for the TTL configured per operation name in the [Cache]
+    section, and keep their ETag/Last-Modified so stale ones can be revalidated
+    with a conditional request. File mtimes track use, the least recently used
+    entries are evicted once the cache grows past `max_size_mb`.
+    """
+
+    def __init__(self, path: str = None, max_size_mb: int = None):
+        self.path = pathlib.Path(path or parser.get("Cache", "path"))
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = (max_size_mb or parser.getint("Cache", "max_size_mb")) * 1024 * 1024
+        # bytes of stored bodies, counted once on the first write and kept up to date after
+        self.size = None
+        self.lock = Lock()
+        self.sweep()
+
+    def ttl(self, operation: str) -> int:
+        """Seconds a response of `operation` stays fresh, 0 when it must not be cached."""
+        return parser.getint("Cache", operation.lower(), fallback=0)
+
+    def key(self, *parts) -> str:
+        return content_hash(*parts)
+
+    def lookup(self, operation: str, *parts) -> CacheLookup:
+        """Looks up the request identified by `parts` under the TTL of `operation`."""
+        return CacheLookup(self, operation, self.key(*parts))
+
+    def get(self, key: str) -> CachedResponse:
+        body_path, meta_path = self.files(key)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not body_path.exists():
+            return None
+
+        self.touch(key)
+        return CachedResponse(body_path, meta)
+
+    def put(self, key: str, body: bytes, headers: dict) -> None:
+        for _ in self.put_stream(key, [body], headers):
+            pass
+
+    def put_stream(self, key: str, chunks, headers: dict):
+        """
+        Stores a body arriving in chunks while passing the chunks through to the caller.
+
+        A caller that stops reading early still gets the entry stored: the rest of
+        the body is read in when the generator is closed. A failed download leaves
+        no temporary file behind.
+        """
+        body_path, meta_path = self.files(key)
+        tmp_path = self.tmp_path(body_path)
+        stored = False
+        try:
+            with open(tmp_path, 'wb') as f:
+                reading = True
+                for chunk in chunks:
+                    f.write(chunk)
+                    if reading:
+                        try:
+                            yield chunk
+                        except GeneratorExit:
+                            reading = False
+            replaced = body_path.stat().st_size if body_path.exists() else 0
+            os.replace(tmp_path, body_path)
+            stored = True
+        finally:
+            if not stored:
+                tmp_path.unlink(missing_ok=True)
+
+        meta = {
+            'stored_at': time.time(),
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+        }
+        self.write(meta_path, json.dumps(meta).encode('utf-8'))
+        self.grow(body_path.stat().st_size - replaced)
+
+    def revalidate(self, key: str) -> None:
+        """Marks an entry fresh again after the server answered 304 Not Modified."""
+        cached = self.get(key)
+        if cached is not None:
+            meta = {'stored_at': time.time(), 'etag': cached.etag, 'last_modified': cached.last_modified}
+            self.write(self.files(key)[1], json.dumps(meta).encode('utf-8'))
+
+    def touch(self, key: str) -> None:
+        for path in self.files(key):
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+    def grow(self, added: int) -> None:
+        """Accounts for `added` bytes of bodies, and evicts once the cache is over its size."""
+        with self.lock:
+            if self.size is None:
+                # the first count already includes the body just written
+                self.size = sum(entry[1] for entry in self.entries())
+            else:
+                self.size += added
+            over = self.size > self.max_size
+        if over:
+            self.evict()
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache fits in `max_size_mb`."""
+        with self.lock:
+            entries = self.entries()
+            size = sum(entry[1] for entry in entries)
+            for _, entry_size, path in sorted(entries):
+                if size <= self.max_size:
+                    break
+                path.unlink(missing_ok=True)
+                path.with_suffix('.json').unlink(missing_ok=True)
+                size -= entry_size
+            # the full scan also corrects the count for entries written by other processes
+            self.size = size
+        self.sweep()
+
+    def sweep(self, max_age: int = 3600) -> None:
+        """Removes the temporary files of writes interrupted over `max_age` seconds ago, those still running are younger."""
+        expired = time.time() - max_age
+        for path in self.path.glob('*.tmp'):
+            try:
+                if path.stat().st_mtime < expired:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def entries(self) -> list:
+        """(mtime, size, path) of every stored body."""
+        entries = []
+        for path in self.path.glob('*.body'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def files(self, key: str) -> tuple:
+        return self.path / f"{key}.body", self.path / f"{key}.json"
+
+    def write(self, path: pathlib.Path, data: bytes) -> None:
+        tmp_path = self.tmp_path(path)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    def tmp_path(self, path: pathlib.Path) -> pathlib.Path:
+        # entries are written to a temporary file first so concurrent readers never see a partial one
+        return path.with_name(f"{path.name}.{os.getpid()}.{get_ident()}.tmp")
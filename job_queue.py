@@ -0,0 +1,147 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+from threading import RLock
+
+from peewee import chunked
+
+from database import CrawlJob, database, SQLITE_MAX_VARIABLES
+from utils import parser
+
+# one unit of crawl work: which parts of a problem to fetch, and the status the catalog reported for it
+CrawlTask = namedtuple("CrawlTask", ["slug", "fetch_detail", "contain_solution", "status"])
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue:
+    """
+    Persistent queue of crawl tasks in the `CrawlJob` table.
+
+    Every slug moves pending -> in_flight -> done, or back to pending with an
+    exponential backoff when its batch fails, until it runs out of attempts and
+    is marked failed. A crawl that crashes or is interrupted leaves its state on
+    disk, and the next run resumes with the slugs that are not done yet.
+
+    Queue updates from the worker threads are serialized on a lock and take the
+    write lock up front, so they never deadlock upgrading a read transaction.
+    """
+
+    def __init__(self):
+        self.max_attempts = parser.getint("Crawler", "max_attempts")
+        self.backoff = parser.getfloat("Crawler", "backoff_seconds")
+        self.lock = RLock()
+
+    def recover(self) -> int:
+        """Returns the jobs left in flight by a crashed or interrupted run to the queue."""
+        return CrawlJob.update(state=PENDING).where(CrawlJob.state == IN_FLIGHT).execute()
+
+    def enqueue(self, tasks: list) -> None:
+        """
+        Adds new tasks, keeping the progress of slugs already queued; failed ones get
+        a fresh start. Failed jobs this run does not ask for again are forgotten, so
+        they are not reported by every later run.
+        """
+        rows = [task._asdict() for task in tasks]
+        slugs = {task.slug for task in tasks}
+        with database.atomic():
+            stale = [slug for slug, in CrawlJob.select(CrawlJob.slug).where(CrawlJob.state == FAILED).tuples() if slug not in slugs]
+            for batch in chunked(stale, SQLITE_MAX_VARIABLES):
+                CrawlJob.delete().where(CrawlJob.slug.in_(batch)).execute()
+
+            for batch in chunked(rows, SQLITE_MAX_VARIABLES // len(CrawlTask._fields)):
+                CrawlJob.insert_many(batch).on_conflict_ignore().execute()
+
+            for batch in chunked([task.slug for task in tasks], SQLITE_MAX_VARIABLES):
+                CrawlJob.update(state=PENDING, attempts=0, next_attempt_at=datetime.now()).where(
+                    CrawlJob.slug.in_(batch), CrawlJob.state == FAILED
+                ).execute()
+
+    def claim(self, limit: int) -> list:
+        """Moves up to `limit` ready jobs in flight and returns them as tasks."""
+        with self.lock, database.atomic('IMMEDIATE'):
+            jobs = list(
+                CrawlJob.select()
+                .where(CrawlJob.state == PENDING, CrawlJob.next_attempt_at <= datetime.now())
+                .order_by(CrawlJob.next_attempt_at, CrawlJob.slug)
+                .limit(limit)
+            )
+            if jobs:
+                self.set_state([job.slug for job in jobs], IN_FLIGHT)
+
+        return [CrawlTask(job.slug, job.fetch_detail, job.contain_solution, job.status) for job in jobs]
+
+    def next_batch(self, limit: int) -> tuple:
+        """
+        Claims up to `limit` ready jobs, with the seconds to wait before polling
+        again when none is ready, None once the queue is drained.
+        """
+        batch = self.claim(limit)
+        if batch:
+            return batch, 0
+        wait = self.seconds_until_ready()
+        return [], None if wait is None else min(max(wait, 0.1), 1)
+
+    def attempts(self, batch: list) -> list:
+        """
+        The groups of tasks to sync for a claimed batch, in order: the whole batch,
+        then each task alone once it failed, so a single bad slug does not use up
+        the attempts of the others. Each outcome goes to `settle`.
+        """
+        return [batch] if len(batch) == 1 else [batch, *[[task] for task in batch]]
+
+    def settle(self, batch: list, tasks: list, error: Exception = None) -> bool:
+        """Records the outcome of one of the `attempts` of `batch`, and returns whether the remaining ones are skipped."""
+        if error is None:
+            self.complete(tasks)
+            return tasks is batch
+
+        print(f"❌ Failed to sync {', '.join(task.slug for task in tasks)}, Reason: {error}")
+        if len(tasks) == 1:
+            self.fail(tasks, error)
+        return False
+
+    def complete(self, tasks: list) -> None:
+        self.set_state([task.slug for task in tasks], DONE)
+
+    def fail(self, tasks: list, error: Exception) -> None:
+        """Schedules the tasks for a retry after an exponential backoff, or marks them failed."""
+        with self.lock, database.atomic('IMMEDIATE'):
+            for job in CrawlJob.select().where(CrawlJob.slug.in_([task.slug for task in tasks])):
+                attempts = job.attempts + 1
+                CrawlJob.update(
+                    state=FAILED if attempts >= self.max_attempts else PENDING,
+                    attempts=attempts,
+                    next_attempt_at=datetime.now() + timedelta(seconds=self.backoff * 2 ** (attempts - 1)),
+                    last_error=str(error),
+                    updated_at=datetime.now(),
+                ).where(CrawlJob.slug == job.slug).execute()
+
+    def seconds_until_ready(self) -> float:
+        """
+        Seconds until a pending job can be claimed, 0 while other workers still have
+        jobs in flight that may be retried, None once the queue is drained.
+        """
+        if CrawlJob.select().where(CrawlJob.state == IN_FLIGHT).exists():
+            return 0
+
+        job = (
+            CrawlJob.select(CrawlJob.next_attempt_at)
+            .where(CrawlJob.state == PENDING)
+            .order_by(CrawlJob.next_attempt_at)
+            .first()
+        )
+        if job is None:
+            return None
+        return max(0, (job.next_attempt_at - datetime.now()).total_seconds())
+
+    def finish(self) -> list:
+        """Forgets the done jobs of a drained queue and returns the slugs that failed for good."""
+        CrawlJob.delete().where(CrawlJob.state == DONE).execute()
+        return [job.slug for job in CrawlJob.select(CrawlJob.slug).where(CrawlJob.state == FAILED)]
+
+    def set_state(self, slugs: list, state: str) -> None:
+        with self.lock:
+            CrawlJob.update(state=state, updated_at=datetime.now()).where(CrawlJob.slug.in_(slugs)).execute()
@@ -0,0 +1,186 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+from threading import Lock
+from urllib.parse import urljoin, urlparse
+
+from peewee import chunked
+import requests
+
+from database import BulkWriter, Media, ProblemDetail, SQLITE_MAX_VARIABLES
+from utils import AdaptiveRateLimiter, parser
+
+IMG_SRC = re.compile(r'''(<img\b[^>]*?\bsrc\s*=\s*)(["'])(.*?)\2''', re.IGNORECASE | re.DOTALL)
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.bmp'}
+
+
+def image_urls(html: str, base_url: str = None) -> list:
+    """Remote images of an html document, resolved against `base_url` ([Crawler] base_url), in order and without duplicates."""
+    base_url = base_url or parser.get("Crawler", "base_url")
+    urls = {}
+    for _, _, src in IMG_SRC.findall(html or ''):
+        url = urljoin(base_url + '/', src.strip())
+        if urlparse(url).scheme in ('http', 'https'):
+            urls[url] = None
+    return list(urls)
+
+
+def localize(html: str, files: dict, base_url: str = None, prefix: str = '') -> tuple:
+    """
+    Points the images of `html` found in `files` (url to media file name) at
+    their local copy, the others at their absolute remote url, a relative src
+    would not resolve inside Anki. Anki only keeps media referenced from
+    templates when their name starts with `prefix` '_'.
+
+    :return: The html and the media file names it now refers to, to bundle with it.
+    """
+    if not html:
+        return html, []
+    base_url = base_url or parser.get("Crawler", "base_url")
+    bundled = {}
+
+    def replace(match):
+        head, quote, src = match.groups()
+        url = urljoin(base_url + '/', src.strip())
+        filename = files.get(url)
+        if filename:
+            bundled[prefix + filename] = None
+            return f'{head}{quote}{prefix}{filename}{quote}'
+        if urlparse(url).scheme in ('http', 'https'):
+            return f'{head}{quote}{url}{quote}'
+        return match.group(0)
+
+    return IMG_SRC.sub(replace, html), list(bundled)
+
+
+class MediaStore:
+    """
+    Content-addressed store of downloaded images.
+
+    Every file is named after the sha256 of its content, so the same image
+    served under several urls is stored once, and a name never changes meaning
+    once bundled into a package. The `Media` table maps each url to its file,
+    a url is only downloaded once.
+
+    With a `limiter`, every download takes its turn in that rate budget and
+    reports back to it, so images are throttled and honour Retry-After along
+    with the requests of the crawl.
+    """
+
+    def __init__(self, path: str = None, headers: dict = None, limiter: AdaptiveRateLimiter = None):
+        self.path = path or parser.get("Media", "path")
+        self.limiter = limiter
+        self.workers = parser.getint("Media", "workers")
+        self.timeout = parser.getfloat("Media", "timeout")
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        # urls being downloaded, so concurrent crawl workers do not fetch the same image twice
+        self.pending = set()
+        self.lock = Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def claim(self, urls: list) -> list:
+        """The `urls` neither stored nor being downloaded, reserved for the caller until `release`."""
+        urls = list(dict.fromkeys(urls))
+        stored = self.files(urls)
+        with self.lock:
+            claimed = [url for url in urls if url not in stored and url not in self.pending]
+            self.pending.update(claimed)
+        return claimed
+
+    def release(self, urls: list) -> None:
+        with self.lock:
+            self.pending.difference_update(urls)
+
+    def download(self, urls: list) -> int:
+        """
+        Downloads the `urls` not stored yet, [Media] workers at a time. A failed
+        download is reported and retried the next time its url is seen.
+
+        :return: Number of images downloaded.
+        """
+        urls = self.claim(urls)
+        if not urls:
+            return 0
+
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(urls))) as executor:
+                files = dict(zip(urls, executor.map(self.fetch, urls)))
+            return self.record(files)
+        finally:
+            self.release(urls)
+
+    def backfill(self, chunk_size: int = 500) -> int:
+        """Downloads the images of the stored problem statements missing from the store, such as those crawled before it existed."""
+        downloaded = 0
+        problems = ProblemDetail.select(ProblemDetail.description).order_by(ProblemDetail.id)
+        for chunk in chunked(problems.tuples().iterator(), chunk_size):
+            downloaded += self.download([url for description, in chunk for url in image_urls(description)])
+        return downloaded
+
+    def fetch(self, url: str) -> str:
+        """Downloads one image into the store, None when it failed."""
+        try:
+            response = self.get(url)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"❌ Failed to download image {url}, Reason: {e}")
+            return None
+        return self.save(url, response.content, response.headers.get('Content-Type'))
+
+    def get(self, url: str) -> requests.Response:
+        if self.limiter is None:
+            return self.session.get(url, timeout=self.timeout)
+
+        self.limiter.acquire()
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.RequestException:
+            self.limiter.record(None, None)
+            raise
+        self.limiter.record(response.elapsed.total_seconds(), response.status_code, response.headers.get('Retry-After'))
+        return response
+
+    def save(self, url: str, content: bytes, content_type: str = None) -> str:
+        """Stores `content` under its content hash, once however many urls serve it, and returns its file name."""
+        extension = os.path.splitext(urlparse(url).path)[1].lower()
+        if extension not in IMAGE_EXTENSIONS:
+            extension = mimetypes.guess_extension((content_type or '').split(';')[0].strip()) or ''
+        filename = hashlib.sha256(content).hexdigest() + extension
+
+        path = self.file_path(filename)
+        if not os.path.exists(path):
+            # written next to its final name first, a concurrent reader never sees a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        return filename
+
+    def record(self, files: dict) -> int:
+        """Maps the downloaded urls to their file, skipping the failed (None) ones."""
+        now = datetime.now()
+        with BulkWriter() as writer:
+            for url, filename in files.items():
+                if filename:
+                    writer.add(Media, url=url, filename=filename, fetched_at=now)
+        return sum(1 for filename in files.values() if filename)
+
+    def files(self, urls: list) -> dict:
+        """File names of the stored `urls`, by url. Files removed from the store since are left out."""
+        files = {}
+        for batch in chunked(list(dict.fromkeys(urls)), SQLITE_MAX_VARIABLES):
+            files.update(Media.select(Media.url, Media.filename).where(Media.url.in_(batch)).tuples())
+        return {url: filename for url, filename in files.items() if os.path.exists(self.file_path(filename))}
+
+    def file_path(self, filename: str) -> str:
+        # template media are bundled as "_<name>", content hashes never start with "_"
+        return os.path.join(self.path, filename.lstrip('_'))
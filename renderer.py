@@ -1,15 +1,34 @@
-import random
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+from datetime import datetime, timedelta
+from functools import reduce
+import operator
+import os
 import re
 
-from genanki import Model, Deck, Note, Package
-from markdown import markdown
+from genanki import Model, Deck, Note
+from markdown import Markdown
+from peewee import chunked
 
-from database import ProblemDetail
-from utils import parser as conf
+from apkg import StreamingPackage
+from database import BulkWriter, database, ExportState, FavouriteQuestion, LeetCodeTrack, ProblemDetail, ProblemTag, RenderCache, Submission, Tag, TopQuestion, SQLITE_MAX_VARIABLES
+from media import MediaStore, image_urls, localize
+from utils import content_hash, parser as conf
 
+# bump whenever the html produced for a submission changes, to invalidate the render cache
+RENDERER_VERSION = 1
 
-def random_id():
-    return random.randrange(1 << 30, 1 << 31)
+
+# one converter per extension set, built once per (worker) process and reset between documents
+_converters = {}
+
+
+def markdown(content: str, extensions: list) -> str:
+    key = tuple(extensions)
+    if key not in _converters:
+        _converters[key] = Markdown(extensions=extensions)
+    return _converters[key].reset().convert(content)
 
 
 def markdown_to_html(content: str):
@@ -29,14 +48,50 @@ def code_to_html(source, language):
     return markdown(content, extensions=['fenced_code'])
 
 
+# built models and their template media, keyed by their (front, back, css) template paths,
+# with the mtimes they were read at
+_model_cache = {}
+
+
+def load_anki_model() -> tuple:
+    """
+    Returns the note model for the configured templates with the media files
+    its templates refer to, rebuilt only when a template file changed since it
+    was last read.
+    """
+    paths = (conf.get("Anki", "front"), conf.get("Anki", 'back'), conf.get("Anki", 'css'))
+    mtimes = tuple(os.stat(path).st_mtime_ns for path in paths)
+
+    cached = _model_cache.get(paths)
+    if cached is None or cached[0] != mtimes:
+        _model_cache[paths] = (mtimes, *build_anki_model(*paths))
+    return _model_cache[paths][1:]
+
+
 def get_anki_model():
-    with open(conf.get("Anki", "front"), 'r') as f:
+    """Returns the note model for the configured templates, see `load_anki_model`."""
+    return load_anki_model()[0]
+
+
+def build_anki_model(front_path: str, back_path: str, css_path: str):
+    with open(front_path, 'r') as f:
         front_template = f.read()
-    with open(conf.get("Anki", 'back'), 'r') as f:
+    with open(back_path, 'r') as f:
         back_template = f.read()
-    with open(conf.get("Anki", 'css'), 'r') as f:
+    with open(css_path, 'r') as f:
         css = f.read()
 
+    # images of the templates are bundled too, reviews never hit the network
+    store = MediaStore()
+    try:
+        urls = image_urls(front_template + back_template)
+        store.download(urls)
+        files = store.files(urls)
+    finally:
+        store.close()
+    front_template, front_media = localize(front_template, files, prefix='_')
+    back_template, back_media = localize(back_template, files, prefix='_')
+
     anki_model = Model(
         model_id=1048217874,
         name="LeetCode",
@@ -64,35 +119,139 @@ def get_anki_model():
         ],
         css=css
     )
-    return anki_model
+    return anki_model, list(dict.fromkeys(front_media + back_media))
 
 
-def make_note(problem):
-    print(f"📓 Producing note for problem: {problem.title}...")
-    tags = ";".join([t.name for t in problem.tags])
-    tags_slug = ";".join([t.slug for t in problem.tags])
+def problem_selection(tags: list = None, levels: list = None, company: str = None, min_frequency: float = 0.0,
+                      favourite: bool = False, track_statuses: list = None):
+    """
+    Compiles deck selectors into one condition on `ProblemDetail`, every selector
+    resolved through an index: tags by (tag, problem), companies by
+    (company, frequency), difficulty, favourites by slug and track status by title.
 
-    try:
-        solution = problem.solution.get()
-    except Exception:
-        solution = None
+    :return: The condition, None when nothing is selected.
+    """
+    conditions = []
+    if tags:
+        conditions.append(ProblemDetail.id.in_(ProblemTag.select(ProblemTag.problem).where(ProblemTag.tag.in_(tags))))
+    if levels:
+        conditions.append(ProblemDetail.level.in_(levels))
+    if company:
+        conditions.append(ProblemDetail.slug.in_(
+            TopQuestion.select(TopQuestion.slug).where(TopQuestion.company == company, TopQuestion.frequency >= min_frequency)
+        ))
+    if favourite:
+        conditions.append(ProblemDetail.slug.in_(FavouriteQuestion.select(FavouriteQuestion.slug)))
+    if track_statuses:
+        conditions.append(ProblemDetail.title.in_(
+            LeetCodeTrack.select(LeetCodeTrack.title).where(LeetCodeTrack.status.in_(track_statuses))
+        ))
+    return reduce(operator.and_, conditions) if conditions else None
+
+
+def load_problems(selection=None):
+    """
+    Loads every problem with its tags and submissions in a fixed number of queries,
+    so building the deck does not query the database once per note. With a
+    `selection`, only the selected problems and their tags and submissions are read.
+
+    :return: List of (problem, tags, submissions) tuples ordered by display id.
+    """
+    problems = ProblemDetail.select().order_by(ProblemDetail.display_id)
+    tag_condition, submission_condition = None, None
+    if selection is not None:
+        problems = problems.where(selection)
+        tag_condition = ProblemTag.problem.in_(ProblemDetail.select(ProblemDetail.id).where(selection))
+        submission_condition = Submission.slug.in_(ProblemDetail.select(ProblemDetail.slug).where(selection))
+
+    tags = load_tags(tag_condition)
+    submissions = load_submissions(submission_condition)
+    return [(problem, tags[problem.id], submissions[problem.slug]) for problem in problems]
+
+
+def iter_problems(selection=None, chunk_size: int = None):
+    """
+    Streams the problems `chunk_size` at a time, each chunk with its tags and
+    submissions, so only one chunk is held in memory. Every chunk is its own
+    query keyed on the display id: a cursor held open across the chunks would
+    pin its read snapshot, and the export could no longer write once the crawler
+    committed.
 
-    codes = []
-    for item in problem.submissions:
-        source = re.sub(r'(\\u[\s\S]{4})',lambda x:x.group(1).encode("utf-8").decode("unicode-escape"),item.source)
-        output = code_to_html(source, item.language)
-        codes.append(output)
-    submissions = "\n".join(codes)
+    :return: Generator of lists of (problem, tags, submissions) tuples ordered by display id.
+    """
+    chunk_size = min(chunk_size or conf.getint("Anki", "chunk_size"), SQLITE_MAX_VARIABLES)
+    problems = ProblemDetail.select().order_by(ProblemDetail.display_id).limit(chunk_size)
+    if selection is not None:
+        problems = problems.where(selection)
+
+    last = None
+    while True:
+        chunk = list(problems if last is None else problems.where(ProblemDetail.display_id > last))
+        if not chunk:
+            return
+        last = chunk[-1].display_id
+        tags = load_tags(ProblemTag.problem.in_([problem.id for problem in chunk]))
+        submissions = load_submissions(Submission.slug.in_([problem.slug for problem in chunk]))
+        yield [(problem, tags[problem.id], submissions[problem.slug]) for problem in chunk]
+
+
+def load_tags(condition=None) -> dict:
+    """Tags of the problems matching `condition`, by problem id."""
+    query = (
+        ProblemTag.select(ProblemTag.problem, Tag.name, Tag.slug)
+        .join(Tag, on=ProblemTag.tag == Tag.slug)
+        .order_by(ProblemTag.id)
+    )
+    if condition is not None:
+        query = query.where(condition)
+
+    tags = defaultdict(list)
+    for problem_id, name, slug in query.tuples():
+        tags[problem_id].append(Tag(name=name, slug=slug))
+    return tags
+
+
+def load_submissions(condition=None) -> dict:
+    """Submissions matching `condition`, by problem slug."""
+    query = Submission.select().order_by(Submission.id)
+    if condition is not None:
+        query = query.where(condition)
+
+    submissions = defaultdict(list)
+    for item in query:
+        submissions[item.slug_id].append(item)
+    return submissions
+
+
+def render_code(code: tuple) -> str:
+    """
+    Renders one (source, language) submission to html.
+
+    Runs in the worker processes of a parallel render, so it only takes plain data.
+    """
+    source, language = code
+    source = re.sub(r'(\\u[\s\S]{4})',lambda x:x.group(1).encode("utf-8").decode("unicode-escape"),source)
+    return code_to_html(source, language)
+
+
+def render_key(source: str, language: str) -> str:
+    return content_hash(source, language, RENDERER_VERSION)
+
+
+def make_note(problem, tags, submission_html, model=None):
+    print(f"📓 Producing note for problem: {problem.title}...")
+    tag_names = ";".join([t.name for t in tags])
+    tags_slug = ";".join([t.slug for t in tags])
 
     note = Note(
-        model=get_anki_model(),
+        model=model or get_anki_model(),
         fields=[
             str(problem.display_id),
             problem.title,
             problem.slug,
             problem.level,
             problem.description,
-            tags,
+            tag_names,
             tags_slug,
             problem.clarify_questions,
             problem.approaches,
@@ -100,31 +259,226 @@ def make_note(problem):
             problem.mistakes,
             problem.note,
             # markdown_to_html(solution.content) if solution else "",
-            submissions
+            submission_html
         ],
         guid=str(problem.display_id),
         sort_field=str(problem.display_id),
-        tags=[t.slug for t in problem.tags]
+        tags=[t.slug for t in tags]
     )
     return note
 
 
-def render_anki():
-    problems = ProblemDetail.select().order_by(
-        ProblemDetail.display_id
-    )
+def render_fields(problems, workers: int = None, executor: ProcessPoolExecutor = None) -> list:
+    """
+    Renders the submission html of every problem. Submissions found in the render
+    cache are reused, only the others are rendered. Results keep the order of `problems`.
+
+    Only the cache entries of these problems are read, so rendering a chunk at a
+    time keeps memory bounded. `executor` reuses a running pool across chunks.
+    """
+    keys = [[render_key(item.source, item.language) for item in submissions] for _, _, submissions in problems]
+    used = {key for problem_keys in keys for key in problem_keys}
+
+    cache = {}
+    for batch in chunked(used, SQLITE_MAX_VARIABLES):
+        cache.update(RenderCache.select(RenderCache.key, RenderCache.html).where(RenderCache.key.in_(batch)).tuples())
+
+    missing = {}
+    for (_, _, submissions), problem_keys in zip(problems, keys):
+        for item, key in zip(submissions, problem_keys):
+            if key not in cache:
+                missing[key] = (item.source, item.language)
 
-    anki_deck = Deck(
-        deck_id=random_id(),
-        name="LeetCode"
+    print(f"📓 Rendering {len(missing)} submissions, {len(used) - len(missing)} from cache")
+    rendered = dict(zip(missing, render_codes(list(missing.values()), workers, executor)))
+    save_render_cache(rendered, used - rendered.keys())
+
+    cache.update(rendered)
+    return ["\n".join(cache[key] for key in problem_keys) for problem_keys in keys]
+
+
+def render_codes(codes: list, workers: int = None, executor: ProcessPoolExecutor = None) -> list:
+    """
+    Renders (source, language) pairs fanned out over `workers` processes
+    (all CPU cores when 0), or over a running `executor`, keeping their order.
+    """
+    workers = pool_size(workers)
+
+    if workers <= 1 or len(codes) <= 1:
+        return [render_code(code) for code in codes]
+
+    chunksize = max(1, len(codes) // (workers * 4))
+    if executor is not None:
+        return list(executor.map(render_code, codes, chunksize=chunksize))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(render_code, codes, chunksize=chunksize))
+
+
+def pool_size(workers: int = None) -> int:
+    """Number of worker processes: [Anki] workers by default, every CPU core for 0."""
+    if workers is None:
+        workers = conf.getint("Anki", "workers")
+    return workers or os.cpu_count()
+
+
+def save_render_cache(rendered: dict, hits: set) -> None:
+    """Stores newly rendered html and refreshes the entries just reused."""
+    now = datetime.now()
+    with database.atomic():
+        with BulkWriter() as writer:
+            for key, html in rendered.items():
+                writer.add(RenderCache, key=key, html=html, used_at=now)
+
+        hits = list(hits)
+        for i in range(0, len(hits), SQLITE_MAX_VARIABLES):
+            RenderCache.update(used_at=now).where(RenderCache.key.in_(hits[i:i + SQLITE_MAX_VARIABLES])).execute()
+
+
+def evict_render_cache() -> None:
+    """Drops the rendered html no export has used for [Anki] cache_ttl_days."""
+    expired = datetime.now() - timedelta(days=conf.getint("Anki", "cache_ttl_days"))
+    RenderCache.delete().where(RenderCache.used_at < expired).execute()
+
+
+def note_checksum(problem, tags, submissions) -> str:
+    """Hash of everything a note is rendered from, to find the notes changed since the last export."""
+    return content_hash(
+        [
+            problem.display_id, problem.title, problem.slug, problem.level, problem.description,
+            problem.clarify_questions, problem.approaches, problem.edgecases, problem.mistakes, problem.note,
+        ],
+        [(t.name, t.slug) for t in tags],
+        [render_key(item.source, item.language) for item in submissions],
     )
 
-    for problem in problems:
-        note = make_note(problem)
-        anki_deck.add_note(note)
 
-    path = conf.get("Anki", "output")
-    Package(anki_deck).write_to_file(path)
+def render_anki(workers: int = None, delta: bool = False, selection=None, shard_by: str = None,
+                packages: bool = False, output: str = None):
+    """
+    Exports the deck under its stable deck id. With `delta`, only the notes changed
+    since the last export are written, to a `-delta.apkg` package next to the output;
+    importing it updates the existing deck in place.
+
+    `selection` (see `problem_selection`) limits the deck to some problems.
+    `shard_by` ('level' or 'tag') splits the notes into `LeetCode::<shard>`
+    subdecks, or with `packages` into one package per shard, zipped in parallel.
+
+    Problems are streamed [Anki] chunk_size at a time from the database into the
+    package collections, so memory stays flat however large the deck is.
+    """
+    path = output or conf.get("Anki", "output")
+    if delta:
+        path = os.path.splitext(path)[0] + "-delta.apkg"
+
+    model, template_media = load_anki_model()
+    store = MediaStore()
+    workers = pool_size(workers)
+    started = datetime.now()
+    writers, decks = {}, {}
+    exported = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) if workers > 1 else contextlib.nullcontext() as executor:
+            for problems in iter_problems(selection):
+                media = localize_images(problems, store)
+                checksums = [note_checksum(*item) for item in problems]
+                if delta:
+                    problems, checksums = changed_problems(problems, checksums)
+                    if not problems:
+                        continue
+
+                submission_html = render_fields(problems, workers, executor)
+                for (problem, tags, _), html in zip(problems, submission_html):
+                    shard = shard_name(problem, tags, shard_by) if shard_by else None
+                    name = f"LeetCode::{shard}" if shard else "LeetCode"
+                    package_path = shard_path(path, shard) if shard and packages else path
+                    if package_path not in writers:
+                        writers[package_path] = StreamingPackage(package_path)
+                        for filename in template_media:
+                            writers[package_path].add_media(filename, store.file_path(filename))
+                    if name not in decks:
+                        decks[name] = build_deck(name)
+                    writers[package_path].add_note(make_note(problem, tags, html, model), decks[name])
+                    for filename in media[problem.id]:
+                        writers[package_path].add_media(filename, store.file_path(filename))
+
+                # committed chunk by chunk, the crawler is never locked out for the whole export
+                save_export_state(problems, checksums, started)
+                exported += len(problems)
+
+        if writers:
+            with ThreadPoolExecutor(max_workers=min(workers, len(writers))) as pool:
+                list(pool.map(StreamingPackage.close, writers.values()))
+    except BaseException:
+        for writer in writers.values():
+            writer.discard()
+        # the notes of this export never reached a package, the next delta exports them again
+        ExportState.delete().where(ExportState.exported_at == started).execute()
+        raise
+    finally:
+        store.close()
+
+    if exported and not delta and selection is None:
+        # a full export drops the state of the problems deleted since the last one;
+        # a partial export leaves the export state of the problems it did not select alone
+        ExportState.delete().where(ExportState.exported_at < started).execute()
+    evict_render_cache()
+
+    if not exported:
+        print("📓 Deck is up to date, nothing to export" if delta else "📓 No problems match the selection, nothing to export")
+        return
+
+    target = next(iter(writers)) if len(writers) == 1 else f"{len(writers)} packages next to {path}"
+    print(f"📓 Exported {exported} notes to {target}")
+
+
+def localize_images(problems: list, store: MediaStore) -> dict:
+    """
+    Points the images of the problem statements of a chunk at their copy in the
+    media store. Only the notes are changed, not the database, and the checksums
+    taken afterwards re-export a note once its images are downloaded.
+
+    :return: The media file names each statement refers to, by problem id.
+    """
+    urls = [url for problem, _, _ in problems for url in image_urls(problem.description)]
+    files = store.files(urls) if urls else {}
+    media = {}
+    for problem, _, _ in problems:
+        problem.description, media[problem.id] = localize(problem.description, files)
+    return media
+
+
+def changed_problems(problems: list, checksums: list) -> tuple:
+    """The problems of a chunk, with their checksums, changed since their last export."""
+    guids = [str(problem.display_id) for problem, _, _ in problems]
+    exported = dict(ExportState.select(ExportState.guid, ExportState.checksum).where(ExportState.guid.in_(guids)).tuples())
+    changed = [i for i, guid in enumerate(guids) if exported.get(guid) != checksums[i]]
+    return [problems[i] for i in changed], [checksums[i] for i in changed]
+
+
+def shard_name(problem, tags, shard_by: str) -> str:
+    """Shard of a note: its difficulty, or its first tag since a note can only live in one deck."""
+    if shard_by == 'level':
+        return problem.level
+    return tags[0].name if tags else 'Untagged'
+
+
+def shard_path(path: str, name: str) -> str:
+    """`LeetCode.apkg` becomes `LeetCode-<shard>.apkg`."""
+    name = re.sub(r'[^\w-]+', '-', name)
+    return f"{os.path.splitext(path)[0]}-{name}.apkg"
+
+
+def build_deck(name: str) -> Deck:
+    # the root deck keeps its configured id, subdecks get a stable one derived from their name
+    deck_id = conf.getint("Anki", "deck_id") if name == "LeetCode" else int(content_hash(name)[:12], 16)
+    return Deck(deck_id=deck_id, name=name)
+
+
+def save_export_state(problems, checksums, exported_at: datetime) -> None:
+    with database.atomic(), BulkWriter() as writer:
+        for (problem, _, _), checksum in zip(problems, checksums):
+            writer.add(ExportState, guid=str(problem.display_id), checksum=checksum, exported_at=exported_at)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,87 @@
+import re
+
+from peewee import fn
+
+from database import ProblemDetail, ProblemSearch, Submission, SubmissionSearch
+
+# bm25 weights of the problem_search columns: title, description, then the personal notes
+PROBLEM_WEIGHTS = {'title': 10.0, 'description': 1.0, 'clarify_questions': 3.0, 'approaches': 3.0,
+                   'mistakes': 3.0, 'edgecases': 3.0, 'note': 3.0}
+
+NOTE_FIELDS = ['clarify_questions', 'approaches', 'mistakes', 'edgecases', 'note']
+
+
+def fts_query(text: str, fields: list = None, raw: bool = False) -> str:
+    """
+    Turns user input into an FTS5 query: every word must match, and a word
+    joined by punctuation such as "off-by-one" matches as a phrase. `raw` input
+    is passed through, to use the FTS5 syntax (OR, NEAR, prefix*, column filters).
+    `fields` limits the match to these columns, "notes" standing for every personal note field.
+    """
+    query = text
+    if not raw:
+        terms = []
+        for word in text.split():
+            tokens = re.findall(r'\w+', word)
+            if tokens:
+                terms.append('"' + ' '.join(tokens) + '"')
+        query = ' '.join(terms)
+
+    if fields and query:
+        columns = [name for field in fields for name in (NOTE_FIELDS if field == 'notes' else [field])]
+        query = '{' + ' '.join(columns) + '} : (' + query + ')'
+    return query
+
+
+def search_problems(query: str, limit: int = 20) -> list:
+    """
+    Problems matching an FTS5 `query`, best first, with a snippet of the column
+    that matched best.
+
+    :return: List of dicts with display_id, title, slug, snippet and score.
+    """
+    score = ProblemSearch.bm25(*PROBLEM_WEIGHTS.values())
+    rows = (
+        ProblemSearch.select(
+            ProblemDetail.display_id,
+            ProblemDetail.title,
+            ProblemDetail.slug,
+            fn.snippet(ProblemSearch._meta.entity, -1, '[', ']', '…', 16).alias('snippet'),
+            score.alias('score'),
+        )
+        .join(ProblemDetail, on=(ProblemDetail.id == ProblemSearch.rowid))
+        .where(ProblemSearch.match(query))
+        .order_by(score)
+        .limit(limit)
+        .dicts()
+    )
+    return list(rows)
+
+
+def search_submissions(query: str, limit: int = 20) -> list:
+    """
+    Submissions whose source matches an FTS5 `query`, best first.
+
+    :return: List of dicts with id, slug, language, snippet and score.
+    """
+    score = SubmissionSearch.bm25()
+    rows = (
+        SubmissionSearch.select(
+            Submission.id,
+            Submission.slug.alias('slug'),
+            Submission.language,
+            fn.snippet(SubmissionSearch._meta.entity, 0, '[', ']', '…', 16).alias('snippet'),
+            score.alias('score'),
+        )
+        .join(Submission, on=(Submission.id == SubmissionSearch.rowid))
+        .where(SubmissionSearch.match(query))
+        .order_by(score)
+        .limit(limit)
+        .dicts()
+    )
+    return list(rows)
+
+
+def plain_snippet(snippet: str) -> str:
+    """Drops the html of problem statements and folds the snippet on one line."""
+    return ' '.join(re.sub(r'<[^>]*>?', ' ', snippet or '').split())
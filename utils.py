@@ -1,16 +1,111 @@
-import random
+import hashlib
+import json
 from configparser import RawConfigParser
-from time import sleep
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from threading import Lock
+from time import monotonic, sleep
 
 # load user info from config
 parser = RawConfigParser()
 parser.read('./project.conf')
 
 
-def random_wait(min_t=3, max_t=5):
-    assert min_t < max_t
-    seconds = random.random() * (max_t - min_t) + min_t
-    sleep(seconds)
+class TokenBucket:
+    """
+    Thread-safe token bucket, shared by every request of a crawl so the total
+    request volume stays under `rate` requests per second.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        assert rate > 0 and burst > 0
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def reserve(self) -> float:
+        """Take one token and return how many seconds the caller has to wait for it."""
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        sleep(self.reserve())
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    """
+    Token bucket whose rate follows the server: it grows by `increase` requests
+    per second after every fast, successful response, and is halved on a 429,
+    a 5xx, a network error or a response slower than `target_latency`. A
+    Retry-After pauses every caller for as long as the server asked.
+    """
+
+    def __init__(self, rate: float, burst: int = 1, min_rate: float = None, max_rate: float = None,
+                 increase: float = 0.01, target_latency: float = 2.0):
+        super().__init__(rate, burst)
+        self.min_rate = min_rate or rate
+        self.max_rate = max_rate or rate
+        self.increase = increase
+        self.target_latency = target_latency
+        self.paused_until = 0.0
+        # exponentially weighted averages of the latency and of the error and throttle rates
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.throttle_rate = 0.0
+
+    def reserve(self) -> float:
+        wait = super().reserve()
+        return max(wait, self.paused_until - monotonic())
+
+    def record(self, latency: float, status_code: int, retry_after: str = None) -> None:
+        """
+        Feeds back how a request went: its latency in seconds and its status code,
+        None for both when it failed before any response arrived.
+        """
+        throttled = status_code == 429
+        failed = status_code is None or status_code >= 500
+        with self.lock:
+            self.throttle_rate = 0.9 * self.throttle_rate + 0.1 * throttled
+            self.error_rate = 0.9 * self.error_rate + 0.1 * failed
+            if latency is not None:
+                self.latency = 0.9 * self.latency + 0.1 * latency if self.latency else latency
+
+            if throttled or failed or (latency or 0) > self.target_latency:
+                self.rate = max(self.min_rate, self.rate / 2)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+            pause = parse_retry_after(retry_after)
+            if pause:
+                self.paused_until = max(self.paused_until, monotonic() + pause)
+
+    def stats(self) -> dict:
+        return {
+            'rate': self.rate,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'throttle_rate': self.throttle_rate,
+        }
+
+
+def parse_retry_after(value: str) -> float:
+    """Seconds to wait from a Retry-After header, given either as seconds or as an HTTP date."""
+    if not value:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return 0
 
 
 def destructure(dictionary, *keys):
@@ -26,15 +121,47 @@ def get(dictionary, key):
     return dictionary
 
 
-def do(func, args=None, kwargs=None, max_retries=3):
-    if args is None:
-        args = []
-    if kwargs is None:
-        kwargs = {}
+def content_hash(*parts) -> str:
+    """Stable hash of json-serializable values, used to detect changed remote content."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+def iter_json_array(chunks, key: str):
+    """
+    Yields the items of the array stored under `key` of a JSON document one at a
+    time, decoding them from an iterable of text chunks instead of loading the
+    whole document.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    marker = f'"{key}"'
+    buffer = ''
+
+    # skip everything up to the opening bracket of the array
+    while True:
+        start = buffer.find(marker)
+        bracket = buffer.find('[', start + len(marker)) if start >= 0 else -1
+        if bracket >= 0:
+            buffer = buffer[bracket + 1:]
+            break
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        buffer += chunk
 
-    while max_retries > 0:
+    while True:
+        buffer = buffer.lstrip(' \t\r\n,')
+        if buffer.startswith(']'):
+            return
         try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            print(f"Failed to execute {func}, Reason: {e}")
-            max_retries -= 1
+            item, end = decoder.raw_decode(buffer)
+        except ValueError:
+            # the item is cut at the end of the buffer, read more
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise
+            buffer += chunk
+            continue
+        yield item
+        buffer = buffer[end:]